@@ -1,130 +1,48 @@
 import os
+import time
 import datetime
 import streamlit as st
-from PIL import Image, ImageDraw, ImageFont
 import tempfile
 from pathlib import Path
-import matplotlib.font_manager as fm
-from modules.common import load_settings, load_ui_config, create_zip, export_settings, generate_qr, clear_temp_folder
+from modules.common import load_settings, load_ui_config, create_zip
+from modules.encode import format_siblings
 from modules.ui import hide_ft_style
-from modules.utils import markdown_to_svg, combine_images
-from modules.utils import filename_matched, filename_excluded, filter_by_date_range, filter_by_language, filter_by_location, full_text_search
-from modules.automator import google_image_search
-
-import itertools
-import urllib.request
-from io import BytesIO
-
-
-def process_shape(image, shape, **kwargs):
-    draw = ImageDraw.Draw(image)
-    if shape == "fill":
-        draw.rectangle((0, 0, st.session_state['canvas_w'], st.session_state['canvas_h']), fill=st.session_state['bc'])
-    elif shape == "circle":
-        draw.ellipse((kwargs['circle_x'] - kwargs['radius'], kwargs['circle_y'] - kwargs['radius'], kwargs['circle_x'] + kwargs['radius'], kwargs['circle_y'] + kwargs['radius']), fill=st.session_state['bc'], outline=None)
-    elif shape == "roundrect":
-        draw.rounded_rectangle((kwargs['rect_x'], kwargs['rect_y'], kwargs['rect_x'] + st.session_state['canvas_w'], kwargs['rect_y'] + st.session_state['canvas_h']), kwargs['radius'], fill=st.session_state['bc'], outline=None)
-    elif shape == "frame":
-        draw.rectangle((kwargs['margin'], kwargs['margin'], st.session_state['canvas_w'] - kwargs['margin'], st.session_state['canvas_h'] - kwargs['margin']), fill=st.session_state['frame_fill'], outline=st.session_state['bc'], width=st.session_state['frame_width'])
-    # draw.rounded_rectangle((st.session_state['rect_x'], st.session_state['rect_y'], st.session_state['rect_x'] + st.session_state['canvas_w'], st.session_state['rect_y'] + st.session_state['canvas_h']), st.session_state['radius'], fill=(0, 0, 0, 0), outline=None)
-    return image
-
-
-def process_image(image, image_dir, image_x, image_y, image_z):
-    for img_path in image_dir:
-        logo_image = Image.open(img_path).convert("RGBA")
-        image_w, image_h = logo_image.size
-        resized_image_w = int(image_w * image_z)
-        resized_image_h = int(image_h * image_z)
-        resized_logo = logo_image.resize((resized_image_w, resized_image_h))
-        image.paste(resized_logo, (image_x, image_y), mask=resized_logo)
-    return image
-
-def process_mask(image, mask_dir, mask_x, mask_y, mask_z):
-    for img_path in mask_dir:
-        mask_image = image.open(img_path).convert("RGBA")
-        mask_w, mask_h = mask_image.size
-        resized_mask_w = int(mask_w * mask_z)
-        resized_mask_h = int(mask_h * mask_z)
-        resized_logo = mask_image.resize((resized_mask_w, resized_mask_h))
-        # TODO: Opacity modification
-        image.paste(resized_logo, (mask_x, mask_y), mask=resized_logo)
-    return image
-
-def process_logotext(image, word, fonts, fc, text_x, text_y, text_z, stroke_fill, stroke_width, **kwargs):
-    font = ImageFont.truetype(fonts, text_z)
-    text_bbox = ImageDraw.Draw(image).textbbox((0, 0), word, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_height = text_bbox[3] - text_bbox[1]
-
-    adjusted_text_x = int((kwargs['canvas_w'] - text_width) * 0.5 + text_x)
-    adjusted_text_y = int((kwargs['canvas_h'] - text_height) * 0.5 + text_y)
-
-    ImageDraw.Draw(image).text((adjusted_text_x, adjusted_text_y),
-                text=word, stroke_fill=stroke_fill, stroke_width=stroke_width, fill=fc, font=font, anchor='lt')
-    return image
-
-
-def process_qr(image, qr_text, qr_size, qr_position, qr_border, **kwargs):
-    qr_size = kwargs['canvas_h'] * 0.005 if kwargs['canvas_h'] < kwargs['canvas_w'] else kwargs['canvas_w'] * 0.005
-    qr_border =  qr_size * 0.2
-    qr_position = (int(kwargs['canvas_w']-30*qr_size),  int(kwargs['canvas_h']-30*qr_size))
-    qr_image = generate_qr(qr_text, qr_size, qr_border)
-    image.paste(qr_image, qr_position)
-    return image
-
-def process_idcon(image, id, size, ext, text, position, **kwargs):
-    url = f"https://avatar.vercel.sh/{id}.{ext}?size={size}&text={text}"
-    position = (int((kwargs['canvas_w']-size) * 0.50),  int((kwargs['canvas_h']-size) * 0.50))
-
-    try:
-        with urllib.request.urlopen(url) as response:
-            if response.status == 200:
-                image_data = response.read()
-                identicon = Image.open(BytesIO(image_data))
-
-                mask = Image.new("L", (size, size), 0)
-                draw = ImageDraw.Draw(mask)
-                circle_mask = (0, 0, size, size)
-                draw.ellipse(circle_mask, fill=255)
-                trimmed_image = Image.new("RGBA", (kwargs['canvas_w'], kwargs['canvas_h']))
-                trimmed_image.paste(identicon, (0,0), mask=mask)
-
-                result_image = image.copy()
-                result_image.paste(trimmed_image, position, mask=trimmed_image)
-
-                return result_image
-    except Exception as e:
-        st.write(e)
-    return None
-
-
-def generate_gif(image_dir, ext, gif_fname, delay):
-    image_paths = []
-    frames = []
-
-    for image_path in os.listdir(image_dir):
-        if image_path.endswith(ext):
-            image_paths.append(os.path.join(image_dir, image_path))
-
-    for image_path in image_paths:
-        image = Image.open(image_path)
-        frames.append(image)
-
-    out_path = os.path.join(image_dir, gif_fname)
-
-    frames[0].save(out_path, format="GIF", append_images=frames[1:], save_all=True, duration=delay, loop=0)
-
-    return out_path
-
-
-def grid_view(file_paths, col_count):
-    # image_count = len(file_paths)
+from modules import trace
+from modules.utils import markdown_to_svg
+from modules.render import iter_variants, variant_params, text_run, output_path
+from modules.parallel import default_workers, cache_settings
+from modules.jobqueue import start_workers, ACTIVE, DONE, FAILED, CANCELLED
+from modules.assets import prefetch, save_upload
+from modules.fonts import font_paths, font_label
+from modules.thumbnail import get_thumbnail, page_count, page_slice
+from modules.animation import ANIMATION_FORMATS, GIF_PALETTES, animation_path
+from modules.sheet import write_sheet
+from modules.pyramid import load_pyramid
+from modules.store import collect_garbage, unique_paths, open_catalog
+
+
+def grid_view(file_paths, col_count, thumb_size, cache_dir):
+    # Only the current page is sent to the browser, as cached thumbnails
     for idx, image_url in enumerate(file_paths):
         col_idx = idx % col_count
         if col_idx == 0:
             col = st.columns(col_count)
-        col[col_idx].image(image_url, caption=os.path.basename(image_url), use_column_width=True)
+        col[col_idx].image(get_thumbnail(image_url, thumb_size, cache_dir), caption=os.path.basename(image_url), use_column_width=True)
+
+
+def pyramid_view(pyramid_dir, view_w=768, view_h=512):
+    # Only the tiles under the viewport are read, whatever the size of the batch
+    if not os.path.exists(os.path.join(pyramid_dir, "pyramid.json")):
+        return
+    pyramid = load_pyramid(pyramid_dir)
+    level = st.slider("Zoom", 0, pyramid.max_level, max(0, pyramid.max_level - 2), key='pyramid_zoom')
+    level_w, level_h = pyramid.level_size(level)
+    left = st.slider("Pan x", 0, max(0, level_w - view_w), 0, key='pyramid_x') if level_w > view_w else 0
+    top = st.slider("Pan y", 0, max(0, level_h - view_h), 0, key='pyramid_y') if level_h > view_h else 0
+    scale = 2 ** (pyramid.max_level - level)
+    index = pyramid.index_at((left + view_w // 2) * scale, (top + view_h // 2) * scale)
+    st.image(pyramid.viewport(level, left, top, min(view_w, level_w), min(view_h, level_h)),
+             caption=f"{index:05d}" if index else None)
 
 
 def generate_images(state, temp_dir, selected_ext, delay, widget_input, widget_filter, widget_view, widget_text, widget_shape, widget_image, widget_mask, widget_qr, widget_idcon, widget_gif, widget_svg, widget_output):
@@ -137,10 +55,8 @@ def generate_images(state, temp_dir, selected_ext, delay, widget_input, widget_f
     # font_paths = fm.findSystemFonts()
     # fontlist = [os.path.splitext(os.path.basename(font_path))[0] for font_path in font_paths]
     # TODO: state --> param ?
-    # Load font
-    for font_path in os.listdir(state['font_dir']):
-        if font_path.endswith(".ttf"):
-            state['fontlist'].append(os.path.join(state['font_path'], font_path))
+    # Load font; the registry is scanned once per process and merging keeps reruns idempotent
+    state['fontlist'] = list(dict.fromkeys(state['fontlist'] + font_paths(state['font_dir'])))
 
 
     with widget_input:
@@ -165,7 +81,7 @@ def generate_images(state, temp_dir, selected_ext, delay, widget_input, widget_f
 
     with widget_text:
         st.title(f'Global')
-        state['font'] = st.selectbox(f"Font", state['fontlist'], key=f'font_global')
+        state['font'] = st.selectbox(f"Font", state['fontlist'], format_func=font_label, key=f'font_global')
         state['text_x'] = st.slider(f"Text x", -500, 500, state['text_x'], 10, key=f'text_x_global')
         state['text_y'] = st.slider(f"Text y", -500, 500, state['text_y'], 10, key=f'text_y_global')
         state['text_z'] = st.slider(f"Text size", 0, 1000, state['text_z'], 8, key=f'text_z_global')
@@ -189,22 +105,16 @@ def generate_images(state, temp_dir, selected_ext, delay, widget_input, widget_f
         elif "frame" in state['shape']:
             state['margin'] = st.slider("Frame margin", 0, min(state['canvas_w'], state['canvas_h'])//2, 0, key=f'margin_global')
 
-    generated_count = 0
-    for index, (values) in enumerate(itertools.product(*[state[label] for label in checked_lists]), start=1):
+    tasks = []
+    for index, variant in iter_variants(state, checked_lists):
 
-        if generated_count >= limits_gen:
+        if len(tasks) >= limits_gen:
             break
 
-        temp_fname = f"{index:05d}-{state['timestamp']}{selected_ext}"
-        temp_image_path = os.path.join(temp_dir, temp_fname)
-        image = Image.new("RGBA", (state['canvas_w'], state['canvas_h']), (0, 0, 0, 0))
-
-        if 'colorlist' in checked_lists:
-            clrs = values[checked_lists.index('colorlist')]
-            state['bc'], state['fc'] = clrs
+        temp_image_path = output_path(temp_dir, index, state['timestamp'], selected_ext)
 
-        if 'shape' in checked_lists:
-            sh = values[checked_lists.index('shape')]
+        if 'shape' in variant:
+            sh = variant['shape']
             with widget_shape:
                 st.title(f'{index:05d}')
                 if "circle" in sh:
@@ -219,18 +129,7 @@ def generate_images(state, temp_dir, selected_ext, delay, widget_input, widget_f
                 elif "frame" in sh:
                     state['margin'] = st.slider("Frame margin", 0, min(state['canvas_w'], state['canvas_h'])//2, 0, key=f'margin_{index}')
 
-                image = process_shape(
-                        image,
-                        sh,
-                        radius=state['radius'],
-                        circle_x=state['circle_x'],
-                        rect_x=state['rect_x'],
-                        rect_y=state['rect_y'],
-                        margin=state['margin']
-                    )
-
-        if 'idcon_id' in checked_lists:
-            idcon_id = values[checked_lists.index('idcon_id')]
+        if 'idcon_id' in variant:
             with widget_idcon:
                 if state['gen_idcon']:
                     st.title(f'{index:05d}')
@@ -241,41 +140,18 @@ def generate_images(state, temp_dir, selected_ext, delay, widget_input, widget_f
                         state['idcon_text'] = st.text_input("Text", "", key=f'idcon_text_{index}')
                     state['idcon_position'] = st.slider(f"idcon Position", 0, 2560, state['idcon_position'], key=f'idcon_position_{index}')
 
-                    image = process_idcon(image,
-                        idcon_id,
-                        state['idcon_size'],
-                        state['idcon_ext'],
-                        state['idcon_text'],
-                        state['idcon_position'],
-                        canvas_w=state['canvas_w'],
-                        canvas_h=state['canvas_h']
-                    )
-
-        if 'wordlist' in checked_lists:
-            wrds = values[checked_lists.index('wordlist')]
-            for wrd in wrds:
+        text_runs = []
+        if 'wordlist' in variant:
+            for wrd in variant['wordlist']:
                 with widget_text:
                     st.title(f'{index:05d}')
-                    state['font'] = st.selectbox(f"Font: {wrd}", state['fontlist'], key=f'font_{wrd}{index}')
+                    state['font'] = st.selectbox(f"Font: {wrd}", state['fontlist'], format_func=font_label, key=f'font_{wrd}{index}')
                     state['text_x'] = st.slider(f"Text x: {wrd}", -500, 500, state['text_x'], 10, key=f'text_x_{wrd}{index}')
                     state['text_y'] = st.slider(f"Text y: {wrd}", -500, 500, state['text_y'], 10, key=f'text_y_{wrd}{index}')
                     state['text_z'] = st.slider(f"Text size: {wrd}", 0, 1000, state['text_z'], 8, key=f'text_z_{wrd}{index}')
                     state['stroke_width'] = st.slider(f"Stroke width : {wrd}", 0, 20, state['stroke_width'], key=f'stroke_width_{wrd}{index}')
                     state['stroke_fill'] = st.text_input(f"Stroke fill: {wrd}", state['stroke_fill'], key=f'stroke_fill_{wrd}{index}')
-
-                    image = process_logotext(
-                        image,
-                        wrd,
-                        state['font'],
-                        state['fc'],
-                        state['text_x'],
-                        state['text_y'],
-                        state['text_z'],
-                        state['stroke_fill'],
-                        state['stroke_width'],
-                        canvas_w=state['canvas_w'],
-                        canvas_h=state['canvas_h']
-                    )
+                    text_runs.append(text_run(state, wrd))
         # with widget_image:
         #     if state['image_dir']:
         #         st.title(f'{index:05d}')
@@ -283,14 +159,6 @@ def generate_images(state, temp_dir, selected_ext, delay, widget_input, widget_f
         #         state['image_y'] = st.slider(f"Image y", -state['canvas_h'], state['canvas_h'], 0, 10, key=f'image_y_{index}')
         #         state['image_z'] = st.slider(f"Image z", 0.2, 10.0, 0.2, 0.1, key=f'image_z_{index}')
 
-        #         image = process_image(
-        #         image,
-        #         state['image_dir'],
-        #         state['image_x'],
-        #         state['image_y'],
-        #         state['image_z']
-        #         )
-
         # with widget_mask:
         #     if state['masks_dir']:
         #         st.title(f'{index:05d}')
@@ -298,42 +166,65 @@ def generate_images(state, temp_dir, selected_ext, delay, widget_input, widget_f
         #         state['mask_y'] = st.slider(f"mask y", -state['canvas_h'], state['canvas_h'], 0, 10, key=f'mask_y_{index}')
         #         state['mask_z'] = st.slider(f"mask z", 0.2, 10.0, 0.2, 0.1, key=f'mask_z_{index}')
 
-        #         image = process_mask(
-        #         image,
-        #         state['masks_dir'],
-        #         state['mask_x'],
-        #         state['mask_y'],
-        #         state['mask_z']
-        #         )
-
-        if 'qr_text' in checked_lists:
-            qr_text = values[checked_lists.index('qr_text')]
+        if 'qr_text' in variant:
             with widget_qr:
                 if state['gen_qr']:
                     st.title(f'{index:05d}')
                     state['qr_position'] = st.slider(f"QR Position",int(0), int(50), state['qr_position'], key=f'qr_position_{index}')
                     state['qr_size'] = st.slider(f"QR Size", 0, 50, state['qr_size'], key=f'qr_size_{index}')
 
-                    image = process_qr(image,
-                    qr_text,
-                    state['qr_size'],
-                    state['qr_position'],
-                    state['qr_border'],
-                    canvas_w=state['canvas_w'],
-                    canvas_h=state['canvas_h']
-                    )
-            image.save(temp_image_path)
-            state['image_paths'].append(temp_image_path)
-            generated_count += 1
-            # st.write(state['image_paths'])
+        params = variant_params(state, variant)
+        params['text_runs'] = text_runs
+        tasks.append((index, params, temp_image_path))
 
+    animation = None
     if state['gen_gif']:
-        gif_fname = f"00000-{state['timestamp']}.gif"
-        images_path = temp_dir
-        # images_path = subfolder_path
-        with widget_output:
-            temp_gif_path = generate_gif(images_path, selected_ext, gif_fname, delay)
-            state['image_paths'].append(temp_gif_path)
+        animation = {
+            'path': animation_path(temp_dir, state['timestamp'], state['anim_format']),
+            'format': state['anim_format'],
+            'delay': delay,
+            'palette': state['gif_palette'],
+        }
+
+    payload = {
+        'temp_dir': temp_dir,
+        'ext': selected_ext,
+        'timestamp': state['timestamp'],
+        'workers': state['workers'],
+        'tasks': tasks,
+        'animation': animation,
+        'pyramid': {'path': os.path.join(temp_dir, f"pyramid-{state['timestamp']}")} if state['gen_pyramid'] else None,
+        'profile': state['gen_profile'],
+        'caches': cache_settings(state),
+    }
+    # Rendering runs in a background worker; a rerun with the same inputs finds the same job and only polls it
+    queue = start_workers(state['job_db'], state['job_workers'])
+    job_id = queue.submit(payload, state['job_priority'])
+    queue.set_priority(job_id, state['job_priority'])
+    job = queue.get(job_id)
+
+    with widget_output:
+        st.progress(job['done'] / max(job['total'], 1))
+        st.caption(f"Job {job['id']}: {job['status']} ({job['done']}/{job['total']})")
+        if job['status'] in ACTIVE and st.button("Cancel", key=f'cancel_{job_id}'):
+            queue.cancel(job_id)
+        if job['status'] in (FAILED, CANCELLED) and st.button("Retry", key=f'retry_{job_id}'):
+            # Variants finished before the failure or cancel are picked up from the checkpoint
+            job = queue.get(queue.submit(payload, state['job_priority'], retry=True))
+        if job['status'] == FAILED:
+            st.error(job['error'])
+        queued = queue.jobs()
+        if queued:
+            st.table([{k: j[k] for k in ('id', 'status', 'priority', 'done', 'total')} for j in queued])
+
+    if job['status'] in (DONE, CANCELLED):
+        state['image_paths'] = job['result'] or []
+    if state.get('pyramid_job') != job['id']:
+        # Read once per job rather than on every poll; a reused job keeps its own pyramid
+        pyramid = queue.get(job['id'], with_payload=True)['payload'].get('pyramid')
+        state['pyramid_job'] = job['id']
+        state['pyramid_dir'] = pyramid['path'] if pyramid else None
+    return job
 
 
 def main():
@@ -401,63 +292,35 @@ def main():
         state['wordlist'] = [tuple(line.split(',')) for line in words.splitlines() if line.strip()]
 
         if st.button("Reset"):
-            clear_temp_folder(temp_dir)
+            freed = collect_garbage(temp_dir)
+            st.caption(f"Removed {freed['files']} files ({freed['bytes'] >> 20} MB)")
 
     widget_filter = st.sidebar.expander("Filter")
-    # with widget_filter:
-    #     match_q = st.text_input("Matching", placeholder="words to match")
-    #     matched_files = []
-    #     if match_q is not None:
-    #         matched_files = filename_matched(match_q, state['image_paths'])
-    #         if matched_files:
-    #             st.write("Matching Files:")
-    #             st.write(matched_files)
-    #         else:
-    #             st.write("No matching files found.")
-
-    #     exclude_q = st.text_input("Excluding", placeholder="words to exclide")
-    #     if exclude_q is not None:
-    #         excluded_files = filename_excluded(exclude_q, state['image_paths'])
-    #         if excluded_files:
-    #             st.write("Excluded Files:")
-    #             st.write(excluded_files)
-    #         else:
-    #             st.write("No excluded files found.")
-
-    #     from_q = st.time_input("From ", datetime.time(8, 45))
-    #     to_q = st.time_input("To ", datetime.time(8, 45))
-    #     if from_q is not None and to_q is not None:
-    #         filtered_by_date = filter_by_date_range(from_q, to_q, state['image_paths'])
-    #         if filtered_by_date:
-    #             st.write("Files within Date Range:")
-    #             st.write(filtered_by_date)
-    #         else:
-    #             st.write("No files found within the specified date range.")
-
-    #     lang_q = st.selectbox("Language", [""])
-    #     if lang_q != "":
-    #         filtered_by_language = filter_by_language(lang_q, state['image_paths'])
-    #         if filtered_by_language:
-    #             st.write("Files filtered by Language:")
-    #             st.write(filtered_by_language)
-    #         else:
-    #             st.write("No files found for the specified language.")
-
-    #     location_q = st.text_input("Location", [""])
-    #     if location_q != "":
-    #         filtered_by_location = filter_by_location(location_q, state['image_paths'])
-    #         if filtered_by_location:
-    #             st.write("Files filtered by Location:")
-    #             st.write(filtered_by_location)
-    #         else:
-    #             st.write("No files found for the location")
+    with widget_filter:
+        # Answered from the output catalog, over every run still in temp_dir
+        catalog = open_catalog(temp_dir)
+        filters = {
+            'match': st.text_input("Matching", placeholder="text in the file name"),
+            'exclude': st.text_input("Excluding", placeholder="text not in the file name"),
+            'word': st.text_input("Word"),
+            'color': st.text_input("Color", placeholder="e.g. #ff or white"),
+            'shape': st.selectbox("Shape", [""] + catalog.values('shape')),
+        }
+        if st.checkbox("Date range"):
+            dates = st.date_input("Dates", (datetime.date.today(), datetime.date.today()))
+            if len(dates) == 2:
+                filters['since'], filters['until'] = dates
+        state['filters'] = {k: v for k, v in filters.items() if v}
 
     widget_view = st.sidebar.expander("View")
     with widget_view:
         state['gen_preview'] = st.checkbox("Preview All", True)
         state['gen_gridview'] = st.checkbox("Grid View", True)
+        state['gen_pyramid'] = st.checkbox("Deep Zoom", state['gen_pyramid'])
         if state['gen_gridview']:
             state['grid_col'] = st.slider("Grid Col",1,8,2)
+            state['thumb_size'] = st.select_slider("Thumbnail size", [128, 256, 512, 1024], state['thumb_size'])
+        state['page_size'] = st.slider("Images per page", 1, 100, state['page_size'])
 
     widget_text = st.sidebar.expander("Text")
     with widget_text:
@@ -476,7 +339,13 @@ def main():
     widget_image = st.sidebar.expander("Image")
     with widget_image:
         state['uploaded_image'] = st.file_uploader("Image", accept_multiple_files=True)
-        state['image_dir'] = [state['uploaded_image'] if state['uploaded_image'] else [].append([])]
+        state['image_dir'] = [save_upload(upload, state['upload_dir']) for upload in state['uploaded_image'] or []]
+        if state['image_dir']:
+            state['image_x'] = st.slider("Image x", -state['canvas_w'], state['canvas_w'], state['image_x'], 10, key='image_x_global')
+            state['image_y'] = st.slider("Image y", -state['canvas_h'], state['canvas_h'], state['image_y'], 10, key='image_y_global')
+            state['image_z'] = st.slider("Image z", 0.1, 10.0, float(state['image_z']), 0.1, key='image_z_global')
+            # Decode at the chosen scale while the rest of the script runs; the job reuses it
+            prefetch(state['image_dir'], [state['image_z']])
 
         search_queries = st.text_input('Google Search Keyword: ', "Apple")
         image_formats = ['png', 'jpg', 'jpeg', 'gif', 'svg', 'bmp', 'tiff', 'webp', 'ico', 'icons', 'pdf']
@@ -492,22 +361,30 @@ def main():
 
         if search_queries:
             with st.spinner("Progress ..."):
+                # from modules.automator import google_image_search  # imported here so selenium stays off the startup path
                 # state['google_image_paths'] = google_image_search(search_queries, image_format, limits, temp_dir, image_size, aspect_ratio, color, image_type, region, safe_search, license)
                 pass
 
         if state['google_image_paths'] is None:
             pass
         else:
-            state['image_dir'].append(state['google_image_paths'])
+            state['image_dir'] += state['google_image_paths']
             # state['image_paths'].append(state['google_image_paths'])
 #
     widget_mask = st.sidebar.expander("Mask")
     with widget_mask:
         state['masks_dir'] = 'images/masks'
         for filename in os.listdir(state['masks_dir']):
-            if filename.endswith(".png"):
-                state['masks'].append(os.path.join(state['masks_dir'], filename))
+            mask_path = os.path.join(state['masks_dir'], filename)
+            if filename.endswith(".png") and mask_path not in state['masks']:
+                state['masks'].append(mask_path)
+        state['gen_mask'] = st.checkbox("Mask", state['gen_mask'])
         state['mask'] = st.selectbox("Mask", state['masks'])
+        if state['gen_mask'] and state['mask']:
+            state['mask_x'] = st.slider("Mask x", -state['canvas_w'], state['canvas_w'], state['mask_x'], 10, key='mask_x_global')
+            state['mask_y'] = st.slider("Mask y", -state['canvas_h'], state['canvas_h'], state['mask_y'], 10, key='mask_y_global')
+            state['mask_z'] = st.slider("Mask z", 0.1, 10.0, float(state['mask_z']), 0.1, key='mask_z_global')
+            prefetch([state['mask']], [state['mask_z']])
 
     widget_qr = st.sidebar.expander("QR")
     with widget_qr:
@@ -522,12 +399,17 @@ def main():
         if state['gen_idcon']:
             state['idcon_id'] = st.text_area("Id", "\n".join(state['idcon_id']))
             state['idcon_id'] = [line for line in state['idcon_id'].splitlines() if line.strip()]
+            state['idcon_source'] = st.selectbox("Source", ["local", "remote"], key='idcon_source_global')
 
     widget_gif = st.sidebar.expander("GIF")
     with widget_gif:
         state['gen_gif'] = st.checkbox("GIF Animation", True)
+        delay = state['delay']
         if state['gen_gif']:
             delay = st.slider("Delay", 0, 5000, 0, 100, key='delay')
+            state['anim_format'] = st.selectbox("Animation Format", list(ANIMATION_FORMATS), key='anim_format_global')
+            if state['anim_format'] == 'gif':
+                state['gif_palette'] = st.selectbox("GIF Palette", GIF_PALETTES, GIF_PALETTES.index(state['gif_palette']))
 
     widget_svg = st.sidebar.expander("SVG")
     with widget_svg:
@@ -539,25 +421,46 @@ def main():
             # svg_text = markdown_to_svg(markdown_text, svg_w, svg_h)
             # st.markdown(svg_text)
             pass # TODO
+        tile_x = st.slider("Tile x", 1, 50, 10)
+        cell_size = st.slider("Cell size", 64, 1024, 256, 64)
         combine = st.button("Combine Images")
-        if combine:
-            tile_x = st.slider("Tile x")
-            tile_y = st.slider("Tile y")
-            image_paths = state['image_paths']
-            # combined_image = combine_images(image_paths, tile_x, tile_y)
-            # st.images(combined_image, caption='Combined Image', use_column_width=True)
-            pass # TODO
 
     widget_output = st.sidebar.expander("Output")
     with widget_output:
         selected_ext = st.selectbox("File Format", state['exts'])
+        state['formats'] = st.multiselect("Also save as", [ext for ext in state['exts'] if ext != selected_ext], [ext for ext in state['formats'] if ext != selected_ext])
+        state['workers'] = st.slider("Workers", 1, default_workers(), min(state['workers'], default_workers()))
+        state['gen_profile'] = st.checkbox("Profiling", state['gen_profile'])
+        state['job_priority'] = st.slider("Priority", 0, 9, state['job_priority'])
 
     try:
         with st.spinner("Processing..."):
-            generate_images(state, temp_dir, selected_ext, delay, widget_input, widget_filter, widget_view, widget_text, widget_shape, widget_image, widget_mask, widget_qr, widget_idcon, widget_gif, widget_svg, widget_output)
+            job = generate_images(state, temp_dir, selected_ext, delay, widget_input, widget_filter, widget_view, widget_text, widget_shape, widget_image, widget_mask, widget_qr, widget_idcon, widget_gif, widget_svg, widget_output)
+        if state.get('pyramid_dir'):
+            # Tiles are flushed while the job runs, so the batch can be browsed before it finishes
+            pyramid_view(state['pyramid_dir'])
     except Exception as e:
+        job = None
         st.error(e)
 
+    if state['gen_profile'] and job is not None and job['status'] not in ACTIVE:
+        with widget_output:
+            # Recorded by the job itself; a job reused from before profiling was on has none
+            if job['trace']:
+                st.table(trace.summary_rows(job['trace']))
+            else:
+                st.caption("No trace recorded for this job")
+
+    if state['filters']:
+        state['image_paths'] = catalog.query(**state['filters'])
+        with widget_filter:
+            st.caption(f"{len(state['image_paths'])} matching outputs")
+
+    if job is not None and job['status'] in ACTIVE:
+        # Poll the job until it finishes; outputs appear once it is done
+        time.sleep(state['job_poll_interval'])
+        st.experimental_rerun()
+
     if state['image_paths'] is None:
         pass
     else:
@@ -566,18 +469,30 @@ def main():
         else:
             state['preview_image'] = [state['image_paths'][0]]
 
+    pages = page_count(len(state['preview_image']), state['page_size'])
+    page = st.number_input("Page", 1, pages, 1) if pages > 1 else 1
+    page_images = page_slice(state['preview_image'], page, state['page_size'])
+
     if state['gen_gridview']:
-        grid_view(state['preview_image'], state['grid_col'])
+        grid_view(page_images, state['grid_col'], state['thumb_size'], state['thumbnail_cache_dir'])
     else:
-        for img in state['preview_image']:
+        for img in page_images:
             st.image(img, caption=os.path.basename(img), use_column_width=True)
 
+    if combine and state['image_paths']:
+        with widget_svg:
+            # Written to disk strip by strip; large sheets are only offered as a download
+            sheet_path = os.path.join(temp_dir, f"sheet-{state['timestamp']}.png")
+            write_sheet(state['image_paths'], sheet_path, tile_x, (cell_size, cell_size))
+            st.download_button("Download contact sheet (.png)", data=open(sheet_path, 'rb'), file_name=os.path.basename(sheet_path), mime="image/png")
+
     with widget_output:
         if st.button("Create Zip"):
             zip_fname = state['zip_fname']
-            zip_path = os.path.join(temp_dir, zip_fname)
-            image_paths = state['image_paths']
-            create_zip(zip_path, image_paths)
+            zip_path = os.path.join(temp_dir, f"archive-{state['timestamp']}.zip")
+            # Streamed to disk, one entry per distinct image plus its extra formats
+            entries = [entry for path in unique_paths(state['image_paths']) for entry in [path] + format_siblings(path, state['formats'])]
+            create_zip(zip_path, entries)
             with open(zip_path, "rb") as file:
                 st.download_button(
                     label="Download images (.zip)",
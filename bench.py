@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+from modules.render import load_spec, process_shape, process_logotext, process_qr, process_idcon, layer_cache
+from modules.fonts import font_cache
+from modules.glyphs import glyph_cache
+from modules.assets import asset_cache
+from modules.identicon import identicon_cache, mask_cache
+from modules.common import qr_matrix_cache
+from modules.composite import coverage_cache, shape_layers
+from modules.animation import open_animation
+from modules.utils import combine_images
+
+
+CACHES = [font_cache, layer_cache, identicon_cache, mask_cache, qr_matrix_cache, coverage_cache, glyph_cache, asset_cache]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the render pipeline stages.")
+    parser.add_argument("--settings", default="settings.json")
+    parser.add_argument("--ui-config", default="ui-config.json")
+    parser.add_argument("--preset", default="FHD (1920, 1080)")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--font", default=None, help="Font for the text stage (default: first loadable font in fontlist)")
+    parser.add_argument("--cold", action="store_true", help="Clear all render caches before every iteration")
+    parser.add_argument("--stages", nargs="*", default=None)
+    parser.add_argument("--baseline", default=None, help="Baseline JSON to compare against")
+    parser.add_argument("--save-baseline", default=None, help="Write the results as a new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p50 slowdown against the baseline (0.2 = 20%%)")
+    return parser.parse_args()
+
+
+BASELINE_KEYS = ('preset', 'iterations', 'cold')
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS. It is the peak over the
+    # process lifetime, which is why every stage runs in a process of its own.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def find_font(spec, font=None):
+    candidates = [font] if font else list(dict.fromkeys(spec['fontlist']))
+    for path in candidates:
+        try:
+            font_cache.clear()
+            process_logotext(Image.new("RGBA", (8, 8)), "A", path, "black", 0, 0, 8, None, 0, canvas_w=8, canvas_h=8)
+            return path
+        except OSError:
+            continue
+    return None
+
+
+def run_stage(name, func, iterations, cold, items=1):
+    latencies = []
+    for i in range(iterations):
+        if cold:
+            for cache in CACHES:
+                cache.clear()
+        start = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - start)
+    total = sum(latencies)
+    return {
+        'iterations': iterations,
+        'throughput': iterations * items / total if total else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def build_stages(spec, font, work_dir, iterations):
+    canvas_w, canvas_h = spec['canvas_w'], spec['canvas_h']
+    colors = [tuple(clrs) for clrs in spec['colorlist']] or [("tan", "black")]
+    words = [word for words in spec['wordlist'] for word in words if word] or ["Logomaker"]
+    blank = lambda: Image.new("RGBA", (canvas_w, canvas_h), (0, 0, 0, 0))
+    shape_kwargs = dict(radius=spec['radius'], circle_x=canvas_w // 2, circle_y=canvas_h // 2, rect_x=0, rect_y=0,
+                        margin=spec['margin'], frame_fill=spec['frame_fill'], frame_width=spec['frame_width'])
+
+    frames = []
+    for i in range(min(iterations, 16)):
+        frame = process_shape(blank(), spec['shapelist'][i % len(spec['shapelist'])], colors[i % len(colors)][0], canvas_w, canvas_h, **shape_kwargs)
+        frame_path = os.path.join(work_dir, f"{i + 1:05d}-bench.png")
+        frame.save(frame_path)
+        frames.append(frame_path)
+
+    def shape(i):
+        process_shape(blank(), spec['shapelist'][i % len(spec['shapelist'])], colors[i % len(colors)][0], canvas_w, canvas_h, **shape_kwargs)
+
+    def shape_batch(i):
+        geometry = {k: v for k, v in shape_kwargs.items() if k != 'frame_fill'}
+        batch = [{'bc': bc, 'frame_fill': spec['frame_fill']} for bc, _ in colors]
+        shape_layers(spec['shapelist'][i % len(spec['shapelist'])], batch, canvas_w, canvas_h, **geometry)
+
+    def logotext(i):
+        process_logotext(blank(), words[i % len(words)], font, colors[i % len(colors)][1], spec['text_x'], spec['text_y'], spec['text_z'],
+                         "black", spec['stroke_width'], canvas_w=canvas_w, canvas_h=canvas_h)
+
+    def qr(i):
+        qr_texts = spec['qr_text'] or ["example.com"]
+        process_qr(blank(), qr_texts[i % len(qr_texts)], spec['qr_size'], spec['qr_position'], spec['qr_border'], canvas_w=canvas_w, canvas_h=canvas_h)
+
+    def idcon(i):
+        idcon_ids = spec['idcon_id'] or ["01_example_id"]
+        process_idcon(blank(), idcon_ids[i % len(idcon_ids)], spec['idcon_size'], "png", "", 0, canvas_w=canvas_w, canvas_h=canvas_h)
+
+    def animation(i):
+        with open_animation(os.path.join(work_dir, "bench.gif"), "gif", spec['delay']) as writer:
+            for frame_path in frames:
+                writer.append(Image.open(frame_path))
+
+    def combine(i):
+        combine_images(frames[:4], 2, 2)
+
+    stages = {
+        'process_shape': (shape, 1),
+        'shape_batch': (shape_batch, len(colors)),
+        'process_logotext': (logotext, 1),
+        'process_qr': (qr, 1),
+        'process_idcon': (idcon, 1),
+        'generate_gif': (animation, len(frames)),
+        'combine_images': (combine, 1),
+    }
+    if font is None:
+        del stages['process_logotext']
+    if len(frames) < 4:
+        del stages['combine_images']
+    return stages
+
+
+def bench_spec(args):
+    spec = load_spec(args.settings, args.ui_config)
+    preset = spec['preset'][args.preset]
+    spec['canvas_w'], spec['canvas_h'] = preset[:2]
+    if len(preset) >= 5:
+        spec['text_x'], spec['text_y'], spec['text_z'] = preset[2:5]
+    return spec
+
+
+def measure_stage(args, font, name):
+    # Runs in a fresh process: the peak RSS is this stage's, not the largest so far
+    spec = bench_spec(args)
+    with tempfile.TemporaryDirectory() as work_dir:
+        func, items = build_stages(spec, font, work_dir, args.iterations)[name]
+        return run_stage(name, func, args.iterations, args.cold, items)
+
+
+def baseline_mismatch(run, baseline):
+    return [(key, baseline.get(key), run[key]) for key in BASELINE_KEYS if baseline.get(key) != run[key]]
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline.get('stages', {}):
+            continue
+        reference = baseline['stages'][name]['p50_ms']
+        if reference and result['p50_ms'] > reference * (1 + tolerance):
+            regressions.append((name, reference, result['p50_ms']))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    spec = bench_spec(args)
+
+    font = find_font(spec, args.font)
+    if font is None:
+        print("No loadable font found, skipping process_logotext (use --font)")
+
+    run = {'preset': args.preset, 'iterations': args.iterations, 'cold': args.cold}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        mismatch = baseline_mismatch(run, baseline)
+        if mismatch:
+            # Timings taken with another preset, iteration count or cache state are not comparable
+            for key, expected, actual in mismatch:
+                print(f"Baseline {args.baseline} has {key}={expected!r}, this run {key}={actual!r}")
+            sys.exit(2)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        names = [name for name in build_stages(spec, font, work_dir, args.iterations) if not args.stages or name in args.stages]
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[name] = executor.submit(measure_stage, args, font, name).result()
+
+    print(f"{'stage':<18}{'ops/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'peak MB':>10}")
+    for name, r in results.items():
+        print(f"{name:<18}{r['throughput']:>10.1f}{r['p50_ms']:>10.2f}{r['p90_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['peak_rss_mb']:>10.1f}")
+
+    report = dict(run, stages=results)
+    if args.save_baseline:
+        with open(args.save_baseline, mode='w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, reference, current in regressions:
+            print(f"REGRESSION {name}: p50 {current:.2f} ms vs baseline {reference:.2f} ms")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
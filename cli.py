@@ -0,0 +1,182 @@
+import os
+import sys
+import argparse
+import datetime
+
+from modules import trace
+from modules.common import iter_zip
+from modules.encode import format_siblings
+from modules.render import load_spec, variant_space, variant_params, output_path, MULTIPLY_LISTS
+from modules.parallel import render_images_parallel, default_workers, cache_settings
+from modules.manifest import open_manifest, render_incremental
+from modules.checkpoint import open_checkpoint, spec_hash, render_resumable
+from modules.animation import ANIMATION_FORMATS, GIF_PALETTES, open_animation, animation_path
+from modules.sheet import write_sheet
+from modules.pyramid import open_pyramid
+from modules.store import open_store, collect_garbage
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Render every variant of a settings file without the web UI.")
+    parser.add_argument("--settings", default="settings.json")
+    parser.add_argument("--ui-config", default="ui-config.json")
+    parser.add_argument("--output", default="outputs")
+    parser.add_argument("--ext", default=".png")
+    parser.add_argument("--formats", nargs="*", default=None, help="Extra formats written next to each output, e.g. .webp .jpg (default: settings 'formats')")
+    parser.add_argument("--limits", type=int, default=None, help="Render at most this many variants (default: all)")
+    parser.add_argument("--workers", type=int, default=default_workers(), help="Render processes (default: CPU count)")
+    parser.add_argument("--animation", choices=list(ANIMATION_FORMATS), default=None, help="Also assemble the batch into an animation")
+    parser.add_argument("--delay", type=int, default=None, help="Animation frame delay in ms (default: settings 'delay')")
+    parser.add_argument("--gif-palette", choices=GIF_PALETTES, default=None, help="GIF colour tables: one per frame, or one for the whole animation sampled from all frames (default: settings 'gif_palette')")
+    parser.add_argument("--zip", default=None, help="Also write the batch to this archive ('-' for stdout)")
+    parser.add_argument("--incremental", action="store_true", help="Reuse outputs whose inputs are unchanged since an earlier run")
+    parser.add_argument("--restart", action="store_true", help="Discard the checkpoint of an interrupted run instead of resuming it")
+    parser.add_argument("--verify", action="store_true", help="Re-hash checkpointed outputs before skipping them")
+    parser.add_argument("--sheet", default=None, help="Also write a contact sheet of the batch: a .png file, or a directory of tiles")
+    parser.add_argument("--sheet-columns", type=int, default=None, help="Contact sheet columns (default: square grid)")
+    parser.add_argument("--sheet-cell", type=int, default=None, help="Shrink each contact sheet entry to fit this many pixels square")
+    parser.add_argument("--pyramid", default=None, help="Also build a Deep Zoom tile pyramid of the batch in this directory")
+    parser.add_argument("--keep-runs", type=int, default=None, help="After the batch, delete the outputs of all but this many newest runs")
+    parser.add_argument("--trace", choices=["json", "prometheus"], default=None, help="Record per-stage timings and dump them in this format")
+    parser.add_argument("--trace-file", default=None, help="Write the trace dump here instead of the log")
+    parser.add_argument("--multiply", nargs="*", choices=MULTIPLY_LISTS, default=None, help="Lists to multiply (default: all)")
+    parser.add_argument("--start", type=int, default=1, help="First variant index to render")
+    parser.add_argument("--stop", type=int, default=None, help="Last variant index to render (default: last)")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="K/N", help="Render only every N-th variant starting at offset K, e.g. 0/4")
+    parser.add_argument("--sample", type=int, default=None, help="Render a random sample of this many variants")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for --sample")
+    return parser.parse_args()
+
+
+def parse_shard(value):
+    try:
+        shard_id, shard_count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected K/N, got {value!r}")
+    if not 0 <= shard_id < shard_count:
+        raise argparse.ArgumentTypeError(f"shard {shard_id} out of range for {shard_count} shards")
+    return shard_id, shard_count
+
+
+def main():
+    args = parse_args()
+    trace.enable(args.trace is not None)
+    spec = load_spec(args.settings, args.ui_config)
+    if args.formats is not None:
+        spec['formats'] = args.formats
+    space = variant_space(spec, args.multiply)
+    if args.shard is not None:
+        indices = space.shard(*args.shard, args.start, args.stop)
+    else:
+        indices = space.indices(args.start, args.stop)
+    if args.sample is not None:
+        indices = space.sample(args.sample, args.seed, indices)
+    if args.limits is not None:
+        indices = indices[:args.limits]
+    total = len(indices)
+    log = sys.stderr if args.zip == "-" else sys.stdout
+    os.makedirs(args.output, exist_ok=True)
+
+    # A rerun of the same spec and selection picks up the interrupted job, keeping its output names
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    checkpoint = open_checkpoint(args.output, spec_hash(spec, space.labels, args.ext, indices), timestamp, args.restart)
+    spec['timestamp'] = checkpoint.timestamp
+    resumed = len(checkpoint.completed)
+    print(f"Rendering {total} variants to {args.output} with {args.workers} workers", file=log)
+    if resumed:
+        print(f"Resuming job {checkpoint.job_id[:16]} with {resumed} variants already done", file=log)
+
+    animation = None
+    if args.animation:
+        delay = spec['delay'] if args.delay is None else args.delay
+        palette = spec.get('gif_palette') if args.gif_palette is None else args.gif_palette
+        animation = open_animation(animation_path(args.output, spec['timestamp'], args.animation), args.animation, delay, palette=palette)
+
+    pyramid = None
+    if args.pyramid:
+        # Grid cells follow the variant index and the layout covers the whole space,
+        # so shards, resumed runs and other --stop/--limits selections fill the same pyramid
+        pyramid = open_pyramid(args.pyramid, len(space))
+
+    keep_images = animation is not None
+    manifest = None
+    if args.incremental:
+        manifest = open_manifest(args.output)
+
+        def render_pending(pending):
+            tasks = []
+            for index, variant in space.iter(pending):
+                tasks.append((variant_params(spec, variant), output_path(args.output, index, spec['timestamp'], args.ext)))
+            return render_incremental(tasks, manifest, args.workers, keep_images=keep_images, settings=cache_settings(spec))
+    else:
+        def render_pending(pending):
+            return render_images_parallel(spec, args.output, args.ext, None, args.multiply, args.workers, keep_images=keep_images, indices=pending)
+    results = render_resumable(indices, checkpoint, render_pending, keep_images, args.verify)
+    image_paths = []
+
+    store = open_store(args.output, spec['timestamp'])
+
+    def rendered_paths():
+        # Repeats of content already in this batch stay on disk as links to one
+        # blob, but are left out of the archive and the animation
+        # Results come in the order of indices; a reused output may carry another run's name
+        for count, (index, result) in enumerate(zip(indices, results), start=1):
+            image_path = result[0] if animation is not None else result
+            first = store.add(image_path, index, variant_params(spec, space.variant(index)))
+            if animation is not None and first:
+                animation.append(result[1])
+            print(f"[{count}/{total}] {image_path}", file=log)
+            image_paths.append(image_path)
+            if pyramid is not None:
+                pyramid.add(index, image_path)
+            if first:
+                # Extra formats go into the archive next to their image
+                yield image_path
+                yield from format_siblings(image_path, spec.get('formats', []))
+
+    if args.zip:
+        # Entries are appended as soon as each variant is on disk
+        out = sys.stdout.buffer if args.zip == "-" else open(args.zip, "wb")
+        try:
+            for chunk in iter_zip(rendered_paths()):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+    else:
+        for image_path in rendered_paths():
+            pass
+    store.close()
+    checkpoint.close()
+
+    if manifest is not None:
+        manifest.save()
+
+    if animation is not None:
+        animation.close()
+        print(f"Animation: {animation.path}", file=log)
+
+    if pyramid is not None:
+        pyramid.close()
+        print(f"Pyramid: {args.pyramid}", file=log)
+
+    if args.sheet and image_paths:
+        cell = None if args.sheet_cell is None else (args.sheet_cell, args.sheet_cell)
+        layout = write_sheet(image_paths, args.sheet, args.sheet_columns, cell)
+        print(f"Contact sheet: {args.sheet} ({layout['width']}x{layout['height']})", file=log)
+
+    if args.keep_runs is not None:
+        freed = collect_garbage(args.output, args.keep_runs)
+        print(f"Removed {freed['files']} files from older runs ({freed['bytes'] >> 20} MB freed)", file=log)
+
+    if args.trace:
+        dump = trace.to_json() if args.trace == "json" else trace.to_prometheus()
+        if args.trace_file:
+            with open(args.trace_file, mode='w', encoding='utf-8') as f:
+                f.write(dump)
+        else:
+            print(dump, file=log)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from abc import ABC, abstractmethod
+from io import BytesIO
+from PIL import Image, GifImagePlugin
+
+from modules import trace
+
+
+# Frames are encoded and written as they arrive, so memory stays at one frame
+# regardless of the length of the animation. Container headers that depend on
+# the frame count are patched in close().
+
+ANIMATION_FORMATS = {
+    'gif': ".gif",
+    'webp': ".webp",
+    'apng': ".png",
+}
+
+
+def png_chunks(data):
+    offset = 8
+    while offset < len(data):
+        size, chunk_type = struct.unpack(">I4s", data[offset:offset + 8])
+        yield chunk_type, data[offset + 8:offset + 8 + size]
+        offset += 12 + size
+
+
+def riff_chunks(data):
+    offset = 12
+    while offset < len(data):
+        chunk_type, size = struct.unpack("<4sI", data[offset:offset + 8])
+        yield chunk_type, data[offset + 8:offset + 8 + size]
+        offset += 8 + size + size % 2
+
+
+class AnimationWriter(ABC):
+    def __init__(self, path, delay=0, loop=0):
+        self.path = path
+        self.delay = delay
+        self.loop = loop
+        self.frame_count = 0
+        self.size = None
+        self.fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def append(self, frame):
+        frame = frame.convert("RGBA")
+        if self.fp is None:
+            self.size = frame.size
+            self.fp = open(self.path, "wb")
+            self.write_header(frame)
+        elif frame.size != self.size:
+            frame = frame.resize(self.size)
+        with trace.span("animation_frame"):
+            self.write_frame(frame)
+        self.frame_count += 1
+
+    def close(self):
+        if self.fp is None:
+            return
+        self.write_trailer()
+        self.fp.close()
+        self.fp = None
+
+    @abstractmethod
+    def write_header(self, frame):
+        pass
+
+    @abstractmethod
+    def write_frame(self, frame):
+        pass
+
+    @abstractmethod
+    def write_trailer(self):
+        pass
+
+
+class GifWriter(AnimationWriter):
+    # Index 255 is reserved for transparent pixels
+    TRANSPARENT = 255
+    # Global mode keeps at most this many thumbnails of this size for the palette
+    PALETTE_SAMPLES = 256
+    SAMPLE_SIZE = (32, 32)
+
+    def __init__(self, path, delay=0, loop=0, palette="local", dither=Image.Dither.NONE):
+        # palette: "local" quantizes every frame with its own colour table,
+        # "global" builds one table from a strided sample of all frames, or
+        # pass a "P" image. The global table is only known once every frame
+        # is in, so global mode spools frames to disk and writes them in close().
+        super().__init__(path, delay, loop)
+        self.palette = palette
+        self.dither = dither
+        self.palette_image = palette if isinstance(palette, Image.Image) else None
+        self.spool_dir = None
+        self.spooled = []
+        self.samples = []
+        self.stride = 1
+
+    def append(self, frame):
+        if self.palette != "global":
+            return super().append(frame)
+        frame = frame.convert("RGBA")
+        if self.spool_dir is None:
+            self.size = frame.size
+            self.spool_dir = tempfile.mkdtemp(prefix="gif-spool-")
+        elif frame.size != self.size:
+            frame = frame.resize(self.size)
+        with trace.span("animation_spool"):
+            spool_path = os.path.join(self.spool_dir, f"{len(self.spooled):06d}.png")
+            frame.save(spool_path, compress_level=1)
+        self.spooled.append(spool_path)
+        if self.frame_count % self.stride == 0:
+            self.samples.append(frame.resize(self.SAMPLE_SIZE, Image.BOX))
+            if len(self.samples) > self.PALETTE_SAMPLES:
+                # Halve the sample and double the stride, so it stays spread over the whole animation
+                self.samples = self.samples[::2]
+                self.stride *= 2
+        self.frame_count += 1
+
+    def close(self):
+        if self.palette == "global" and self.spool_dir is not None:
+            spooled, self.spooled = self.spooled, []
+            columns = 16
+            rows = -(-len(self.samples) // columns)
+            width, height = self.SAMPLE_SIZE
+            mosaic = Image.new("RGBA", (columns * width, rows * height))
+            for i, sample in enumerate(self.samples):
+                mosaic.paste(sample, ((i % columns) * width, (i // columns) * height))
+            self.palette_image = self.build_palette(mosaic)
+            self.samples = []
+            try:
+                self.frame_count = 0
+                for spool_path in spooled:
+                    with Image.open(spool_path) as frame:
+                        super().append(frame)
+            finally:
+                shutil.rmtree(self.spool_dir, ignore_errors=True)
+                self.spool_dir = None
+        super().close()
+
+    def build_palette(self, frame):
+        quantized = frame.convert("RGB").quantize(colors=self.TRANSPARENT, dither=self.dither)
+        palette = quantized.getpalette()[:self.TRANSPARENT * 3]
+        palette += [0, 0, 0] * (self.TRANSPARENT - len(palette) // 3)
+        palette_image = Image.new("P", (1, 1))
+        # Duplicate colour 0 into the transparent slot so quantize never picks it
+        palette_image.putpalette(palette + palette[:3])
+        return palette_image
+
+    def write_header(self, frame):
+        if self.palette_image is None:
+            self.palette_image = self.build_palette(frame)
+        palette = bytes(self.palette_image.getpalette()[:768]).ljust(768, b"\0")
+        width, height = self.size
+        self.fp.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0xF7, 0, 0) + palette)
+        self.fp.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", self.loop) + b"\0")
+
+    def write_frame(self, frame):
+        local = self.palette == "local" and self.frame_count > 0
+        palette_image = self.build_palette(frame) if local else self.palette_image
+        indexed = frame.convert("RGB").quantize(palette=palette_image, dither=self.dither)
+        transparent = frame.getchannel("A").point(lambda a: 255 if a < 128 else 0)
+        indexed.paste(self.TRANSPARENT, mask=transparent)
+        params = dict(duration=self.delay, transparency=self.TRANSPARENT, disposal=2, include_color_table=local)
+        for data in GifImagePlugin.getdata(indexed, **params):
+            self.fp.write(data)
+
+    def write_trailer(self):
+        self.fp.write(b";")
+
+
+class ApngWriter(AnimationWriter):
+    def __init__(self, path, delay=0, loop=0, compress_level=6):
+        super().__init__(path, delay, loop)
+        self.compress_level = compress_level
+        self.sequence = 0
+        self.actl_offset = None
+
+    def write_chunk(self, chunk_type, body):
+        self.fp.write(struct.pack(">I", len(body)) + chunk_type + body)
+        self.fp.write(struct.pack(">I", zlib.crc32(chunk_type + body) & 0xFFFFFFFF))
+
+    def encode(self, frame):
+        buffer = BytesIO()
+        frame.save(buffer, format="PNG", compress_level=self.compress_level)
+        return list(png_chunks(buffer.getvalue()))
+
+    def write_header(self, frame):
+        self.fp.write(b"\x89PNG\r\n\x1a\n")
+        for chunk_type, body in self.encode(frame):
+            if chunk_type == b"IHDR":
+                self.write_chunk(chunk_type, body)
+        self.actl_offset = self.fp.tell()
+        self.write_chunk(b"acTL", struct.pack(">II", 0, self.loop))
+
+    def write_frame(self, frame):
+        width, height = self.size
+        self.write_chunk(b"fcTL", struct.pack(">IIIIIHHBB", self.sequence, width, height, 0, 0, self.delay, 1000, 0, 0))
+        self.sequence += 1
+        for chunk_type, body in self.encode(frame):
+            if chunk_type != b"IDAT":
+                continue
+            if self.frame_count == 0:
+                self.write_chunk(b"IDAT", body)
+            else:
+                self.write_chunk(b"fdAT", struct.pack(">I", self.sequence) + body)
+                self.sequence += 1
+
+    def write_trailer(self):
+        self.write_chunk(b"IEND", b"")
+        self.fp.seek(self.actl_offset)
+        self.write_chunk(b"acTL", struct.pack(">II", self.frame_count, self.loop))
+
+
+class WebpWriter(AnimationWriter):
+    def __init__(self, path, delay=0, loop=0, quality=80, lossless=False, method=4):
+        super().__init__(path, delay, loop)
+        self.quality = quality
+        self.lossless = lossless
+        self.method = method
+
+    def write_chunk(self, chunk_type, body):
+        self.fp.write(chunk_type + struct.pack("<I", len(body)) + body + b"\0" * (len(body) % 2))
+
+    def write_header(self, frame):
+        width, height = self.size
+        self.fp.write(b"RIFF\0\0\0\0WEBP")
+        # Animation and alpha flags, canvas size stored minus one as 24-bit values
+        self.write_chunk(b"VP8X", struct.pack("<I", 0x12) + (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little"))
+        self.write_chunk(b"ANIM", struct.pack("<IH", 0, self.loop))
+
+    def write_frame(self, frame):
+        buffer = BytesIO()
+        frame.save(buffer, format="WEBP", quality=self.quality, lossless=self.lossless, method=self.method)
+        width, height = self.size
+        body = bytearray()
+        body += (0).to_bytes(3, "little") + (0).to_bytes(3, "little")
+        body += (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little")
+        body += self.delay.to_bytes(3, "little") + b"\x02"
+        for chunk_type, data in riff_chunks(buffer.getvalue()):
+            if chunk_type in (b"ALPH", b"VP8 ", b"VP8L"):
+                body += chunk_type + struct.pack("<I", len(data)) + data + b"\0" * (len(data) % 2)
+        self.write_chunk(b"ANMF", bytes(body))
+
+    def write_trailer(self):
+        size = self.fp.tell() - 8
+        self.fp.seek(4)
+        self.fp.write(struct.pack("<I", size))
+
+
+GIF_PALETTES = ("local", "global")
+
+
+def open_animation(path, format="gif", delay=0, loop=0, palette=None, **kwargs):
+    # palette only applies to GIF; WebP and APNG frames are truecolour
+    if format == 'gif' and palette is not None:
+        kwargs['palette'] = palette
+    writers = {'gif': GifWriter, 'webp': WebpWriter, 'apng': ApngWriter}
+    return writers[format](path, delay, loop, **kwargs)
+
+
+def animation_path(image_dir, timestamp, format="gif"):
+    return os.path.join(image_dir, f"00000-{timestamp}{ANIMATION_FORMATS[format]}")
@@ -0,0 +1,93 @@
+import os
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image
+
+from modules import trace
+from modules.cache import LRUCache
+from modules.common import write_atomic
+
+
+# Decoded, converted and resized overlay images (logos, masks), keyed by
+# (source, scale). Cached images are shared; callers must not draw on them.
+
+def image_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+asset_cache = LRUCache(maxsize=256, maxbytes=256 << 20, sizeof=image_nbytes)
+
+_pending = {}
+_pending_lock = threading.Lock()
+_executor = {}
+
+
+def source_key(source):
+    if isinstance(source, (str, os.PathLike)):
+        stat = os.stat(source)
+        return os.fspath(source), stat.st_mtime_ns, stat.st_size
+    # Uploaded files have no stable path; identify them by content
+    return 'upload', hashlib.sha256(source.getvalue()).hexdigest()
+
+
+def load_asset(source, scale=1.0):
+    with trace.span("asset_decode"):
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        with Image.open(source) as image:
+            image = image.convert("RGBA")
+        if scale != 1.0:
+            image_w, image_h = image.size
+            image = image.resize((int(image_w * scale), int(image_h * scale)))
+    return image
+
+
+def get_asset(source, scale=1.0):
+    key = source_key(source) + (scale,)
+    with _pending_lock:
+        asset = asset_cache.get(key)
+        if asset is not None:
+            return asset
+        # Concurrent requests for the same asset wait for one decode
+        future = _pending.get(key)
+        owner = future is None
+        if owner:
+            future = _pending[key] = Future()
+    if not owner:
+        return future.result()
+
+    try:
+        asset = load_asset(source, scale)
+        asset_cache.put(key, asset)
+        future.set_result(asset)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _pending_lock:
+            del _pending[key]
+    return asset
+
+
+def save_upload(upload, upload_dir):
+    # Uploads are written once under their content hash, so render jobs get a
+    # plain path and the cache keys them like any other file
+    data = upload.getvalue()
+    path = os.path.join(upload_dir, hashlib.sha256(data).hexdigest()[:32] + os.path.splitext(upload.name)[1].lower())
+    if not os.path.exists(path):
+        os.makedirs(upload_dir, exist_ok=True)
+        write_atomic(path, data)
+    return path
+
+
+def prefetch_executor(workers=None):
+    if 'pool' not in _executor:
+        _executor['pool'] = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1), thread_name_prefix="asset-prefetch")
+    return _executor['pool']
+
+
+def prefetch(sources, scales=(1.0,), workers=None):
+    # Decoding runs in Pillow's C code without the GIL, so threads overlap well
+    executor = prefetch_executor(workers)
+    return [executor.submit(get_asset, source, scale) for source in sources for scale in scales]
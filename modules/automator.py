@@ -1,14 +1,19 @@
 import os
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
+import atexit
+import threading
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
 
-from modules.utils import get_md5_hash
+from modules import trace
+from modules.fetch import fetch_all
 
 
-def google_image_search(query, image_format, limits, temp_dir, image_size, aspect_ratio, color, image_type, region, safe_search, license):
+def new_chrome_driver():
+    # Selenium is only needed once a search actually runs
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+
     options = Options()
     options.add_argument("--headless")
     options.add_argument('--blink-settings=imagesEnabled=false')
@@ -27,42 +32,117 @@ def google_image_search(query, image_format, limits, temp_dir, image_size, aspec
     options.add_experimental_option('useAutomationExtension', False)
     service = Service(executable_path='./chromedriver_linux64')
 
-    driver = webdriver.Chrome(options=options, service=service)
-    search_url = f'https://www.google.com/search?tbm=isch&q={query}&tbs=ift:{image_format}'
+    with trace.span("driver_start"):
+        return webdriver.Chrome(options=options, service=service)
+
+
+class DriverPool:
+    # Browsers are expensive to start, so they are kept between searches and
+    # handed out one caller at a time. At most `size` exist at once.
+    def __init__(self, size=2, factory=new_chrome_driver):
+        self.size = size
+        self.factory = factory
+        self.created = 0
+        self.idle = LifoQueue()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def driver(self, timeout=None):
+        driver = self.acquire(timeout)
+        try:
+            yield driver
+        except Exception:
+            # The session may be wedged; replace it rather than hand it out again
+            self.discard(driver)
+            raise
+        self.idle.put(driver)
+
+    def acquire(self, timeout=None):
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.idle.get(timeout=timeout)
+        try:
+            return self.factory()
+        except Exception:
+            with self._lock:
+                self.created -= 1
+            raise
+
+    def discard(self, driver):
+        with self._lock:
+            self.created -= 1
+        try:
+            driver.quit()
+        except Exception as e:
+            print(f"Failed to quit driver. Reason: {e}")
+
+    def close(self):
+        while True:
+            try:
+                driver = self.idle.get_nowait()
+            except Empty:
+                return
+            self.discard(driver)
+
+
+driver_pool = DriverPool()
+atexit.register(driver_pool.close)
+
+
+def search_url(query, image_format, image_size, aspect_ratio, color, image_type, region, safe_search, license):
+    url = f'https://www.google.com/search?tbm=isch&q={query}&tbs=ift:{image_format}'
 
     if image_size:
-        search_url += f'&tbs=isz:{image_size}'
+        url += f'&tbs=isz:{image_size}'
     if aspect_ratio:
-        search_url += f'&tbs=iar:{aspect_ratio}'
+        url += f'&tbs=iar:{aspect_ratio}'
     if color:
-        search_url += f'&tbs=ic:{color}'
+        url += f'&tbs=ic:{color}'
     if image_type:
-        search_url += f'&tbs=itp:{image_type}'
+        url += f'&tbs=itp:{image_type}'
     if region:
-        search_url += f'&gl={region}'
+        url += f'&gl={region}'
     if safe_search:
-        search_url += f'&safe={safe_search}'
+        url += f'&safe={safe_search}'
     if license:
-        search_url += f'&tbs=sur:{license}'
+        url += f'&tbs=sur:{license}'
+    return url
 
-    try:
-        driver.get(search_url)
-        image_links = []
-        for _ in range(3):
-            for element in driver.find_elements(By.TAG_NAME, "body"):
-                element.send_keys(Keys.END)
-        image_elements = driver.find_elements(By.CSS_SELECTOR, "img.rg_i")
 
+def collect_image_urls(driver, url, limits):
+    from selenium.webdriver.common.keys import Keys
+    from selenium.webdriver.common.by import By
 
-        for i, element in enumerate(image_elements[:limits]):
-            image_url = element.get_attribute('src')
-            image_filename = f"{i+1:05d}_{get_md5_hash(image_url)}.{image_format}"
-            temp_file_path = os.path.join(temp_dir, image_filename)
-            element.screenshot(temp_file_path)
-            image_links.append((image_url, image_filename, temp_file_path))
+    driver.get(url)
+    for _ in range(3):
+        for element in driver.find_elements(By.TAG_NAME, "body"):
+            element.send_keys(Keys.END)
+    image_urls = []
+    for element in driver.find_elements(By.CSS_SELECTOR, "img.rg_i"):
+        image_url = element.get_attribute('src') or element.get_attribute('data-src')
+        if image_url:
+            image_urls.append(image_url)
+        if len(image_urls) >= limits:
+            break
+    return image_urls
 
-        return image_links
 
-    finally:
-        driver.quit()
+def google_image_search(query, image_format, limits, temp_dir, image_size, aspect_ratio, color, image_type, region, safe_search, license, concurrency=16):
+    # The browser only lists result URLs; the images themselves are downloaded concurrently
+    url = search_url(query, image_format, image_size, aspect_ratio, color, image_type, region, safe_search, license)
+    with driver_pool.driver() as driver:
+        with trace.span("search_page"):
+            image_urls = collect_image_urls(driver, url, limits)
 
+    image_links = []
+    for image_url, temp_file_path in fetch_all(image_urls, temp_dir, image_format, concurrency):
+        if temp_file_path is not None:
+            image_links.append((image_url, os.path.basename(temp_file_path), temp_file_path))
+    return image_links
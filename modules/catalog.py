@@ -0,0 +1,210 @@
+import os
+import re
+import sqlite3
+import datetime
+from contextlib import closing
+
+from modules import trace
+
+
+# Every rendered variant with the parameters that produced it, so filters
+# are SQLite lookups instead of scans over file names. Substring filters go
+# through an FTS5 trigram index where SQLite has one.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    idx INTEGER,
+    timestamp TEXT,
+    created REAL,
+    ext TEXT,
+    bc TEXT COLLATE NOCASE,
+    fc TEXT COLLATE NOCASE,
+    words TEXT,
+    font TEXT,
+    shape TEXT,
+    qr_text TEXT,
+    idcon_id TEXT,
+    blob TEXT
+);
+CREATE INDEX IF NOT EXISTS outputs_name ON outputs (name);
+CREATE INDEX IF NOT EXISTS outputs_timestamp ON outputs (timestamp, idx);
+CREATE INDEX IF NOT EXISTS outputs_bc ON outputs (bc);
+CREATE INDEX IF NOT EXISTS outputs_fc ON outputs (fc);
+CREATE INDEX IF NOT EXISTS outputs_shape ON outputs (shape);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS outputs_fts USING fts5(name, words, font, qr_text, idcon_id, tokenize='trigram');
+"""
+
+TEXT_COLUMNS = ('name', 'words', 'font', 'qr_text', 'idcon_id')
+TIMESTAMP = re.compile(r"\d{8}_\d{6}")
+TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S"
+
+
+def to_timestamp(value, end=False):
+    # Range bounds may be datetimes, dates, or timestamp strings
+    if value is None or isinstance(value, str):
+        return value
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time.max if end else datetime.time.min)
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+def fts_phrase(column, text):
+    escaped = text.replace('"', '""')
+    return f'{column}:"{escaped}"'
+
+
+def output_row(path, params, index=None, blob=None):
+    params = params or {}
+    runs = params.get('text_runs', [])
+    name = os.path.basename(path)
+    timestamp = TIMESTAMP.search(name)
+    try:
+        created = os.path.getmtime(path)
+    except OSError:
+        created = None
+    return {
+        'path': path,
+        'name': name,
+        'idx': index,
+        'timestamp': timestamp.group() if timestamp else params.get('timestamp'),
+        'created': created,
+        'ext': os.path.splitext(name)[1].lower(),
+        'bc': params.get('bc'),
+        'fc': params.get('fc'),
+        'words': " ".join(str(run['word']) for run in runs if run['word']),
+        'font': " ".join(dict.fromkeys(str(run['font']) for run in runs)),
+        'shape': params.get('shape'),
+        'qr_text': params.get('qr_text'),
+        'idcon_id': params.get('idcon_id'),
+        'blob': blob,
+    }
+
+
+class OutputCatalog:
+    def __init__(self, path, flush_every=256):
+        self.path = path
+        self.flush_every = flush_every
+        self.pending = []
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.connect() as db, db:
+            db.executescript(SCHEMA)
+            try:
+                db.executescript(FTS_SCHEMA)
+            except sqlite3.OperationalError:
+                # SQLite before 3.34 has no trigram tokenizer; substring filters scan instead
+                pass
+            self.fts = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'outputs_fts'").fetchone() is not None
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        return closing(db)
+
+    def add(self, path, params, index=None, blob=None):
+        self.pending.append(output_row(path, params, index, blob))
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        # Reuse can hand one file to several variants; the last row for a path wins
+        rows = list({row['path']: row for row in self.pending}.values())
+        self.pending = []
+        columns = list(rows[0])
+        with trace.span("catalog_flush"), self.connect() as db, db:
+            # A path written again (a resumed or repeated run) replaces its row
+            paths = [(row['path'],) for row in rows]
+            if self.fts:
+                db.executemany("DELETE FROM outputs_fts WHERE rowid IN (SELECT id FROM outputs WHERE path = ?)", paths)
+            db.executemany("DELETE FROM outputs WHERE path = ?", paths)
+            insert = f"INSERT INTO outputs ({', '.join(columns)}) VALUES ({', '.join(':' + c for c in columns)})"
+            ids = [db.execute(insert, row).lastrowid for row in rows]
+            if self.fts:
+                db.executemany(
+                    f"INSERT INTO outputs_fts (rowid, {', '.join(TEXT_COLUMNS)}) VALUES (?{', ?' * len(TEXT_COLUMNS)})",
+                    [(row_id, *(row[c] for c in TEXT_COLUMNS)) for row_id, row in zip(ids, rows)])
+
+    def close(self):
+        self.flush()
+
+    def filters(self, match=None, exclude=None, word=None, font=None, qr_text=None, idcon_id=None,
+                color=None, shape=None, since=None, until=None, timestamp=None):
+        # FROM and WHERE for a filter set. Substrings of 3+ characters are one
+        # trigram MATCH; shorter ones, and everything without FTS5, use LIKE.
+        # All filters combine with AND; color matches a prefix of either colour.
+        terms, where, args = [], [], []
+        for column, text in (('name', match), ('words', word), ('font', font), ('qr_text', qr_text), ('idcon_id', idcon_id)):
+            if not text:
+                continue
+            if self.fts and len(text) >= 3:
+                terms.append(fts_phrase(column, text))
+            else:
+                where.append(f"o.{column} LIKE ?")
+                args.append(f"%{text}%")
+        if exclude:
+            if self.fts and len(exclude) >= 3:
+                where.append("o.id NOT IN (SELECT rowid FROM outputs_fts WHERE outputs_fts MATCH ?)")
+                args.append(fts_phrase('name', exclude))
+            else:
+                where.append("o.name NOT LIKE ?")
+                args.append(f"%{exclude}%")
+        if color:
+            where.append("(o.bc LIKE ? OR o.fc LIKE ?)")
+            args += [f"{color}%", f"{color}%"]
+        if shape:
+            where.append("o.shape = ?")
+            args.append(shape)
+        if timestamp:
+            where.append("o.timestamp = ?")
+            args.append(timestamp)
+        if since is not None:
+            where.append("o.timestamp >= ?")
+            args.append(to_timestamp(since))
+        if until is not None:
+            where.append("o.timestamp <= ?")
+            args.append(to_timestamp(until, end=True))
+
+        source = "outputs o"
+        if terms:
+            # CROSS JOIN keeps the MATCH as the outer loop instead of one MATCH per row
+            source = "outputs_fts CROSS JOIN outputs o ON o.id = outputs_fts.rowid"
+            where.insert(0, "outputs_fts MATCH ?")
+            args.insert(0, " AND ".join(terms))
+        return source + (" WHERE " + " AND ".join(where) if where else ""), args
+
+    def query(self, limit=None, offset=0, **filters):
+        # Paths in run and index order
+        source, args = self.filters(**filters)
+        sql = f"SELECT o.path FROM {source} ORDER BY o.timestamp, o.idx"
+        if limit:
+            sql += f" LIMIT {int(limit)} OFFSET {int(offset)}"
+        with trace.span("catalog_query"), self.connect() as db:
+            return [row['path'] for row in db.execute(sql, args)]
+
+    def count(self, **filters):
+        source, args = self.filters(**filters)
+        with self.connect() as db:
+            return db.execute(f"SELECT COUNT(*) FROM {source}", args).fetchone()[0]
+
+    def values(self, column):
+        # Distinct values of a column, e.g. for a select box
+        with self.connect() as db:
+            return [row[0] for row in db.execute(f"SELECT DISTINCT {column} FROM outputs WHERE {column} IS NOT NULL ORDER BY 1")]
+
+    def prune(self):
+        # Drops rows whose file is gone, e.g. after garbage collection
+        self.flush()
+        with self.connect() as db, db:
+            missing = [(row['id'],) for row in db.execute("SELECT id, path FROM outputs") if not os.path.exists(row['path'])]
+            if self.fts:
+                db.executemany("DELETE FROM outputs_fts WHERE rowid = ?", missing)
+            db.executemany("DELETE FROM outputs WHERE id = ?", missing)
+        return len(missing)
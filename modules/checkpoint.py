@@ -0,0 +1,136 @@
+import os
+import json
+import hashlib
+from PIL import Image
+
+from modules import trace
+from modules.manifest import RENDER_VERSION, file_digest
+
+
+# Append-only log of finished variants, one JSON object per line. A crash can
+# only tear the last line, which is ignored on load.
+
+def job_hash(*parts):
+    data = json.dumps([RENDER_VERSION, *parts], sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def index_key(indices):
+    # Shards and --start/--stop give ranges, which hash as three ints; samples hash as their list
+    if indices is None:
+        return None
+    if isinstance(indices, range):
+        return [indices.start, indices.stop, indices.step]
+    return list(indices)
+
+
+def spec_hash(spec, checked_lists, ext, indices=None):
+    # Runs over different index selections (e.g. shards side by side) get their own checkpoints
+    spec = {k: v for k, v in spec.items() if k != 'timestamp'}
+    return job_hash(spec, checked_lists, ext, index_key(indices))
+
+
+def checkpoint_path(temp_dir, job_id):
+    return os.path.join(temp_dir, f"job-{job_id[:16]}.jsonl")
+
+
+class JobCheckpoint:
+    def __init__(self, path, job_id, timestamp=None, sync_every=32):
+        self.path = path
+        self.job_id = job_id
+        self.timestamp = timestamp
+        self.sync_every = sync_every
+        self.completed = {}
+        self.unsynced = 0
+        self.file = None
+        torn = False
+        if os.path.exists(path):
+            torn = self.load()
+        self.file = open(path, mode='a', encoding='utf-8')
+        if torn:
+            self.file.write("\n")
+        if self.file.tell() == 0:
+            self.write({'job': job_id, 'timestamp': timestamp})
+
+    def load(self):
+        with open(self.path, encoding='utf-8') as f:
+            lines = f.read().split("\n")
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if 'job' in entry:
+                self.timestamp = entry['timestamp']
+            else:
+                self.completed[entry['index']] = entry
+        return lines[-1] != ""
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def done(self, index, verify=False):
+        entry = self.completed.get(index)
+        if entry is None:
+            return False
+        try:
+            if os.path.getsize(entry['path']) != entry['size']:
+                return False
+        except OSError:
+            return False
+        return not verify or file_digest(entry['path']) == entry['sha256']
+
+    def pending(self, indices, verify=False):
+        return [index for index in indices if not self.done(index, verify)]
+
+    def record(self, index, path):
+        entry = {'index': index, 'path': path, 'size': os.path.getsize(path), 'sha256': file_digest(path)}
+        self.completed[index] = entry
+        self.write(entry)
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_checkpoint(temp_dir, job_id, timestamp=None, restart=False):
+    path = checkpoint_path(temp_dir, job_id)
+    if restart and os.path.exists(path):
+        os.remove(path)
+    return JobCheckpoint(path, job_id, timestamp)
+
+
+def render_resumable(indices, checkpoint, render_pending, keep_images=False, verify=False):
+    # render_pending(pending_indices) must yield results in the order given
+    pending = checkpoint.pending(indices, verify)
+    pending_set = set(pending)
+    rendered = render_pending(pending)
+    for index in indices:
+        if index in pending_set:
+            result = next(rendered)
+            checkpoint.record(index, result[0] if keep_images else result)
+            yield result
+            continue
+        trace.count("variants_resumed")
+        path = checkpoint.completed[index]['path']
+        if keep_images:
+            with Image.open(path) as image:
+                yield path, image.convert("RGBA")
+        else:
+            yield path
@@ -1,47 +1,160 @@
+import io
 import os
-import glob
+import copy
 import json
+import time
 import zipfile
-import streamlit as st
-import qrcode
+import threading
+import contextlib
+import numpy as np
+from PIL import Image
+
+from modules import trace
+from modules.cache import LRUCache
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    # Yields a temp name to write instead of path, renamed over path on success.
+    # Readers never see a half-written file, and a hard link at path (see
+    # store.py) is replaced rather than rewritten. The pid and thread id keep
+    # worker processes and UI job threads writing the same path apart.
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+def write_atomic(path, data):
+    with atomic_path(path) as temp_path:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
 
 
 def clear_temp_folder(folder_path):
-    file_list = glob.glob(os.path.join(folder_path, "*"))
-    for file_path in file_list:
-        try:
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-            elif os.path.isdir(file_path):
-                os.rmdir(file_path)
-        except Exception as e:
-            print(f"Failed to delete {file_path}. Reason: {e}")
+    from modules.store import collect_garbage
+    return collect_garbage(folder_path)
+
+config_cache = LRUCache(maxsize=8)
+
+
+def read_config(file):
+    # Files on disk are parsed once per change; callers get their own copy to mutate
+    if not isinstance(file, (str, os.PathLike)):
+        return json.load(file)
+    stat = os.stat(file)
+
+    def parse():
+        with open(file) as f:
+            return json.load(f)
+
+    return copy.deepcopy(config_cache.get_or_create((os.fspath(file), stat.st_mtime_ns, stat.st_size), parse))
+
 
 def load_settings(file):
-    with open(file) as f:
-        config = json.load(f)
+    import streamlit as st
+    config = read_config(file)
     for k, v in config.items():
         st.session_state[k] = v
 
 def load_ui_config(file):
-    with open(file) as f:
-        config = json.load(f)
+    import streamlit as st
+    config = read_config(file)
     for k, v in config.items():
         if k not in st.session_state:
             st.session_state[k] = v
 
+# Already-compressed formats are stored as-is instead of being deflated again
+STORED_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".zip"}
+
+
+class ZipStream(io.RawIOBase):
+    # Unseekable sink; zipfile falls back to data descriptors and never seeks back
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        trace.count("zip_bytes", len(b))
+        self.chunks.append(bytes(b))
+        self.offset += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.offset
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def zip_entry(arcname, source):
+    if isinstance(source, (bytes, bytearray)):
+        date_time = time.localtime()[:6]
+    else:
+        date_time = time.localtime(os.path.getmtime(source))[:6]
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    if os.path.splitext(arcname)[1].lower() in STORED_EXTS:
+        zinfo.compress_type = zipfile.ZIP_STORED
+    else:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+    return zinfo
+
+
+def iter_zip(entries, chunk_size=1 << 20):
+    # entries: (arcname, path or bytes) pairs, or plain paths
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w") as zipf:
+        for entry in entries:
+            arcname, source = entry if isinstance(entry, tuple) else (os.path.basename(entry), entry)
+            with zipf.open(zip_entry(arcname, source), "w") as dest:
+                if isinstance(source, (bytes, bytearray)):
+                    dest.write(source)
+                else:
+                    with open(source, "rb") as src:
+                        for block in iter(lambda: src.read(chunk_size), b""):
+                            dest.write(block)
+                            yield from stream.drain()
+            yield from stream.drain()
+    yield from stream.drain()
+
 def create_zip(zip_path, filelist):
-    with zipfile.ZipFile(zip_path, "w") as zipf:
-        for file in filelist:
-            zipf.write(file, os.path.basename(file))
+    with open(zip_path, "wb") as f:
+        for chunk in iter_zip(filelist):
+            f.write(chunk)
 
 def export_settings(export_data, export_path):
     with open(export_path, mode='w', encoding='utf-8') as f:
         json.dump(export_data, f, ensure_ascii=False, indent=2)
 
-def generate_qr(raw_text, size, border):
-    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=size, border=border)
+# qrcode.constants.ERROR_CORRECT_*, spelled out so qrcode is only imported once a QR is built
+ERROR_CORRECTION = {'L': 1, 'M': 0, 'Q': 3, 'H': 2}
+
+qr_matrix_cache = LRUCache(maxsize=256)
+
+
+def build_qr_matrix(raw_text, error_correction):
+    import qrcode
+    qr = qrcode.QRCode(version=1, error_correction=ERROR_CORRECTION[error_correction], border=0)
     qr.add_data(raw_text)
     qr.make(fit=True)
-    qr_image = qr.make_image(fill_color="black", back_color="white")
-    return qr_image
\ No newline at end of file
+    return np.array(qr.get_matrix(), dtype=bool)
+
+def qr_matrix(raw_text, error_correction='L'):
+    return qr_matrix_cache.get_or_create((raw_text, error_correction), lambda: build_qr_matrix(raw_text, error_correction))
+
+def generate_qr(raw_text, size, border, error_correction='L', fill_color=(0, 0, 0, 255), back_color=(255, 255, 255, 255)):
+    # Scale the module matrix with NumPy instead of drawing every module
+    box_size = max(1, int(round(size)))
+    border = max(0, int(round(border)))
+    modules = np.pad(qr_matrix(raw_text, error_correction), border)
+    pixels = np.repeat(np.repeat(modules, box_size, axis=0), box_size, axis=1)
+    rgba = np.where(pixels[..., None], np.array(fill_color, dtype=np.uint8), np.array(back_color, dtype=np.uint8))
+    return Image.fromarray(rgba, "RGBA")
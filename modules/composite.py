@@ -0,0 +1,159 @@
+import numpy as np
+from PIL import Image, ImageColor
+
+from modules.cache import LRUCache
+
+
+# Array-backed compositing. Shapes become anti-aliased coverage masks (uint8
+# H x W) computed from signed distances, and colour is applied afterwards, so
+# one mask serves every colour in a colorlist.
+
+coverage_cache = LRUCache(maxsize=16)
+
+
+def axis_coverage(length, start, stop):
+    # Fraction of each pixel [i, i + 1) inside [start, stop)
+    centers = np.arange(length, dtype=np.float32) + 0.5
+    return np.clip(np.minimum(centers - start, stop - centers) + 0.5, 0.0, 1.0)
+
+
+def to_mask(cover):
+    return np.rint(cover * 255.0).astype(np.uint8)
+
+
+def disc_coverage(mask, cx, cy, radius, x0, y0, x1, y1):
+    # Anti-aliased disc, evaluated only inside the window [x0, x1) x [y0, y1)
+    height, width = mask.shape
+    x0, y0 = max(int(x0), 0), max(int(y0), 0)
+    x1, y1 = min(int(np.ceil(x1)), width), min(int(np.ceil(y1)), height)
+    if x1 <= x0 or y1 <= y0:
+        return
+    xs = np.arange(x0, x1, dtype=np.float32)[None, :] + 0.5
+    ys = np.arange(y0, y1, dtype=np.float32)[:, None] + 0.5
+    mask[y0:y1, x0:x1] = to_mask(np.clip(radius + 0.5 - np.hypot(xs - cx, ys - cy), 0.0, 1.0))
+
+
+def box_coverage(width, height, x0, y0, x1, y1, radius=0):
+    # Axis-aligned boxes are separable; rounded corners are patched with a disc per corner
+    mask = to_mask(axis_coverage(height, y0, y1)[:, None] * axis_coverage(width, x0, x1)[None, :])
+    radius = max(0, min(radius, (x1 - x0) / 2, (y1 - y0) / 2))
+    if radius > 0:
+        for cx, wx0, wx1 in ((x0 + radius, x0, x0 + radius), (x1 - radius, x1 - radius, x1)):
+            for cy, wy0, wy1 in ((y0 + radius, y0, y0 + radius), (y1 - radius, y1 - radius, y1)):
+                disc_coverage(mask, cx, cy, radius, wx0, wy0, wx1, wy1)
+    return mask
+
+
+def shape_coverages(shape, canvas_w, canvas_h, **kwargs):
+    # Returns [(mask, colour key)], where the key is 'bc' or 'frame_fill'.
+    # Boxes follow ImageDraw, whose coordinates include the far edge.
+    if shape == "fill":
+        return [(np.full((canvas_h, canvas_w), 255, dtype=np.uint8), 'bc')]
+    if shape == "circle":
+        cx, cy, r = kwargs['circle_x'] + 0.5, kwargs['circle_y'] + 0.5, kwargs['radius'] + 0.5
+        mask = np.zeros((canvas_h, canvas_w), dtype=np.uint8)
+        disc_coverage(mask, cx, cy, r, cx - r - 1, cy - r - 1, cx + r + 1, cy + r + 1)
+        return [(mask, 'bc')]
+    if shape == "roundrect":
+        x0, y0 = kwargs['rect_x'], kwargs['rect_y']
+        return [(box_coverage(canvas_w, canvas_h, x0, y0, x0 + canvas_w + 1, y0 + canvas_h + 1, kwargs['radius']), 'bc')]
+    if shape == "frame":
+        m, w = kwargs['margin'], kwargs['frame_width']
+        outer = box_coverage(canvas_w, canvas_h, m, m, canvas_w - m + 1, canvas_h - m + 1)
+        inner = box_coverage(canvas_w, canvas_h, m + w, m + w, canvas_w - m + 1 - w, canvas_h - m + 1 - w)
+        return [(inner, 'frame_fill'), (outer - inner, 'bc')]
+    return []
+
+
+def cached_coverages(shape, canvas_w, canvas_h, **kwargs):
+    key = (shape, canvas_w, canvas_h) + tuple(sorted(kwargs.items()))
+    return coverage_cache.get_or_create(key, lambda: shape_coverages(shape, canvas_w, canvas_h, **kwargs))
+
+
+def rgba(color):
+    if color is None:
+        return None
+    if isinstance(color, str):
+        color = ImageColor.getrgb(color)
+    color = tuple(color)
+    return color if len(color) == 4 else color + (255,)
+
+
+def pack(colors):
+    # RGBA rows -> one uint32 per colour in memory order, so a fill is a single broadcast
+    return np.ascontiguousarray(np.asarray(colors, dtype=np.uint8).reshape(-1, 4)).view(np.uint32)[:, 0]
+
+
+def scale_alpha(mask, alpha):
+    # round(mask * alpha / 255) in uint16 without a division
+    scaled = mask.astype(np.uint16)
+    scaled *= np.uint16(alpha)
+    scaled += 128
+    scaled += scaled >> 8
+    scaled >>= 8
+    return scaled.astype(np.uint8)
+
+
+def colorize(mask, colors):
+    # One broadcast for N colours: (H, W) x (N, 4) -> (N, H, W, 4) straight-alpha uint8.
+    # Uncovered pixels stay (0, 0, 0, 0), as with ImageDraw on a clear canvas.
+    colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 4)
+    rgb = colors.copy()
+    rgb[:, 3] = 0
+    out = (pack(rgb)[:, None, None] * (mask[None] > 0)).view(np.uint8).reshape(len(colors), *mask.shape, 4)
+    for i, alpha in enumerate(colors[:, 3]):
+        out[i, ..., 3] = mask if alpha == 255 else scale_alpha(mask, alpha)
+    return out
+
+
+def over(dst, src, opacity=1.0):
+    # Porter-Duff "over" on straight-alpha float arrays in [0, 1], broadcast over any leading axes
+    src_a = src[..., 3:] * opacity
+    dst_a = dst[..., 3:] * (1.0 - src_a)
+    out_a = src_a + dst_a
+    out_rgb = (src[..., :3] * src_a + dst[..., :3] * dst_a) / np.where(out_a > 0, out_a, 1.0)
+    return np.concatenate([out_rgb, out_a], axis=-1)
+
+
+def over_uint8(dst, src):
+    # "over" for uint8 RGBA arrays of any leading shape. Pixels where only one side is
+    # visible are copied as packed words; the blend math runs on the overlap alone.
+    src_alpha = src[..., 3]
+    src_visible = src_alpha > 0
+    out = dst.copy()
+    np.copyto(out.view(np.uint32), src.view(np.uint32), where=src_visible[..., None])
+    overlap = src_visible & (src_alpha < 255) & (dst[..., 3] > 0)
+    if overlap.any():
+        blended = over(dst[overlap].astype(np.float32) / 255.0, src[overlap].astype(np.float32) / 255.0)
+        out[overlap] = np.rint(blended * 255.0).astype(np.uint8)
+    return out
+
+
+def shape_layers(shape, colors, canvas_w, canvas_h, **kwargs):
+    # colors: one {'bc': ..., 'frame_fill': ...} per batch item; returns (N, H, W, 4) uint8
+    batch = None
+    for mask, key in cached_coverages(shape, canvas_w, canvas_h, **kwargs):
+        layer_colors = [rgba(item.get(key)) for item in colors]
+        if all(color is None for color in layer_colors):
+            continue
+        layer = colorize(mask, [color or (0, 0, 0, 0) for color in layer_colors])
+        batch = layer if batch is None else over_uint8(batch, layer)
+    if batch is None:
+        return np.zeros((len(colors), canvas_h, canvas_w, 4), dtype=np.uint8)
+    return batch
+
+
+def paste_over(image, overlay, position, opacity=1.0):
+    # Alpha-blend overlay onto image in place, clipped to the canvas
+    x, y = position
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + overlay.width, image.width), min(y + overlay.height, image.height)
+    if right <= left or bottom <= top:
+        return image
+    overlay = overlay.crop((left - x, top - y, right - x, bottom - y))
+    if opacity < 1.0:
+        pixels = np.array(overlay.convert("RGBA"))
+        pixels[..., 3] = scale_alpha(pixels[..., 3], round(opacity * 255))
+        overlay = Image.fromarray(pixels, "RGBA")
+    image.alpha_composite(overlay.convert("RGBA"), (left, top))
+    return image
@@ -0,0 +1,82 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from modules import trace
+from modules.common import atomic_path
+
+
+# Save options per extension. 'mode' converts before saving and 'background'
+# fills transparency for modes without alpha; everything else goes to save().
+ENCODE_PROFILES = {
+    '.png': {'compress_level': 6, 'optimize': False},
+    '.jpg': {'mode': "RGB", 'background': "white", 'quality': 90, 'optimize': True},
+    '.jpeg': {'mode': "RGB", 'background': "white", 'quality': 90, 'optimize': True},
+    '.webp': {'quality': 90, 'method': 4, 'lossless': False},
+    '.tiff': {'compression': "tiff_deflate"},
+    '.gif': {},
+    '.eps': {'mode': "RGB", 'background': "white"},
+    '.ico': {},
+}
+
+_pool = {}
+# A forked worker inherits the dict but not the pool's threads; it starts its own
+os.register_at_fork(after_in_child=_pool.clear)
+
+
+def encode_options(spec):
+    return {
+        'profiles': spec.get('encode_profiles', {}),
+        'formats': [ext for ext in spec.get('formats', [])],
+    }
+
+
+def profile_for(ext, overrides=None):
+    profile = dict(ENCODE_PROFILES.get(ext.lower(), {}))
+    profile.update((overrides or {}).get(ext.lower(), {}))
+    return profile
+
+
+def flatten(image, mode, background):
+    if image.mode == mode:
+        return image
+    if image.mode == "RGBA" and "A" not in mode:
+        canvas = Image.new("RGBA", image.size, background)
+        canvas.alpha_composite(image)
+        image = canvas
+    return image.convert(mode)
+
+
+def save_image(image, path, overrides=None):
+    profile = profile_for(os.path.splitext(path)[1], overrides)
+    mode = profile.pop('mode', None)
+    background = profile.pop('background', "white")
+    if mode:
+        image = flatten(image, mode, background)
+    # An earlier output at this path may be a hard link into the output store
+    with atomic_path(path) as temp_path:
+        image.save(temp_path, format=Image.registered_extensions()[os.path.splitext(path)[1].lower()], **profile)
+    return path
+
+
+def save_formats(image, path, options=None):
+    # Writes path plus a sibling per extra format, e.g. 00001-x.png and 00001-x.webp
+    options = options or {}
+    stem, ext = os.path.splitext(path)
+    for fmt in [ext] + [f for f in options.get('formats', []) if f.lower() != ext.lower()]:
+        with trace.span("encode_save"):
+            save_image(image, stem + fmt, options.get('profiles'))
+    return path
+
+
+def format_siblings(path, formats):
+    # The extra formats save_formats wrote next to path, e.g. 00001-x.webp for 00001-x.png
+    stem, ext = os.path.splitext(path)
+    return [stem + fmt for fmt in formats if fmt.lower() != ext.lower() and os.path.exists(stem + fmt)]
+
+
+def encode_pool():
+    # zlib, libwebp and libjpeg release the GIL, so encoding overlaps the next render
+    if 'pool' not in _pool:
+        _pool['pool'] = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="encode")
+    return _pool['pool']
@@ -0,0 +1,94 @@
+import os
+import asyncio
+import hashlib
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from modules import trace
+from modules.cache import LRUCache
+from modules.common import write_atomic
+from modules.utils import get_md5_hash
+
+
+USER_AGENT = "Mozilla/5.0 (compatible; logomaker)"
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Files written by any fetch in this process, keyed by (dest_dir, md5 of the bytes)
+fetched_content = LRUCache(maxsize=4096)
+
+
+def download(url, timeout=10):
+    # Also handles the data: URIs that search result thumbnails often use
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+
+def retryable(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in RETRY_STATUS
+    return isinstance(error, (urllib.error.URLError, TimeoutError, ConnectionError))
+
+
+class Fetcher:
+    # Downloads into dest_dir as <md5 of url>.<ext>. A URL whose file already
+    # exists is not fetched again, and responses with identical bytes share the
+    # first file written, also across calls through fetched_content. Requests
+    # still in flight are only shared within one fetch_all call.
+    def __init__(self, dest_dir, ext, concurrency=16, retries=3, timeout=10, backoff=0.5):
+        self.dest_dir = dest_dir
+        self.ext = ext
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.by_content = {}
+
+    def path_for(self, url):
+        return os.path.join(self.dest_dir, f"{get_md5_hash(url)}.{self.ext}")
+
+    async def fetch(self, url, semaphore):
+        path = self.path_for(url)
+        if os.path.exists(path):
+            trace.count("fetch_cached")
+            return path
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    with trace.span("fetch_download"):
+                        data = await asyncio.to_thread(download, url, self.timeout)
+                    break
+                except Exception as e:
+                    if attempt == self.retries or not retryable(e):
+                        print(f"Failed to fetch {url}. Reason: {e}")
+                        return None
+                    trace.count("fetch_retries")
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+        digest = hashlib.md5(data).hexdigest()
+        key = (os.path.abspath(self.dest_dir), digest)
+        existing = self.by_content.get(digest) or fetched_content.get(key)
+        if existing is not None and (digest in self.by_content or os.path.exists(existing)):
+            trace.count("fetch_duplicates")
+            return existing
+        self.by_content[digest] = path
+        await asyncio.to_thread(write_atomic, path, data)
+        fetched_content.put(key, path)
+        return path
+
+    async def fetch_all_async(self, urls):
+        os.makedirs(self.dest_dir, exist_ok=True)
+        # urllib blocks, so each in-flight download needs its own thread
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency))
+        semaphore = asyncio.Semaphore(self.concurrency)
+        unique = list(dict.fromkeys(urls))
+        paths = await asyncio.gather(*(self.fetch(url, semaphore) for url in unique))
+        by_url = dict(zip(unique, paths))
+        return [(url, by_url[url]) for url in urls]
+
+
+def fetch_all(urls, dest_dir, ext, concurrency=16, retries=3, timeout=10):
+    # Returns [(url, path or None)] in input order
+    fetcher = Fetcher(dest_dir, ext, concurrency, retries, timeout)
+    with trace.span("fetch_batch"):
+        return asyncio.run(fetcher.fetch_all_async(urls))
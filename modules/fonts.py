@@ -0,0 +1,82 @@
+import os
+from PIL import ImageFont
+
+from modules import trace
+from modules.cache import LRUCache
+
+
+FONT_EXTS = ('.ttf', '.otf', '.ttc')
+
+# Sample characters used to tell which scripts a font can draw
+SCRIPT_SAMPLES = {
+    'latin': "Ag",
+    'kana': "あア",
+    'han': "漢字",
+    'hangul': "한글",
+}
+
+# Parsed FreeType faces keyed by (path, size); each render process keeps its own
+font_cache = LRUCache(maxsize=64)
+# Font metadata keyed by (path, mtime, size), and directory listings keyed by (dir, mtime)
+font_info_cache = LRUCache(maxsize=1024)
+registry_cache = LRUCache(maxsize=8)
+
+
+def open_font(path, size):
+    with trace.span("font_load"):
+        return ImageFont.truetype(path, size)
+
+
+def load_font(path, size):
+    return font_cache.get_or_create((path, size), lambda: open_font(path, size))
+
+
+def has_glyphs(font, text, notdef):
+    return all(bytes(font.getmask(char)) != notdef for char in text)
+
+
+def read_font_info(path):
+    info = {'path': path, 'family': None, 'style': None, 'scripts': []}
+    try:
+        font = ImageFont.truetype(path, 24)
+    except OSError as e:
+        # e.g. a Git LFS pointer that was never fetched
+        info['error'] = str(e)
+        return info
+    info['family'], info['style'] = font.getname()
+    # Missing characters all render as the .notdef box
+    notdef = bytes(font.getmask("\uffff"))
+    info['scripts'] = [script for script, sample in SCRIPT_SAMPLES.items() if has_glyphs(font, sample, notdef)]
+    return info
+
+
+def font_info(path):
+    stat = os.stat(path)
+    return font_info_cache.get_or_create((path, stat.st_mtime_ns, stat.st_size), lambda: read_font_info(path))
+
+
+def scan_fonts(font_dir):
+    paths = sorted(
+        os.path.join(font_dir, name) for name in os.listdir(font_dir)
+        if name.lower().endswith(FONT_EXTS))
+    return [font_info(path) for path in paths]
+
+
+def font_registry(font_dir):
+    # Rescanned only when a font is added to or removed from the directory
+    try:
+        key = (font_dir, os.stat(font_dir).st_mtime_ns)
+    except OSError:
+        return []
+    return registry_cache.get_or_create(key, lambda: scan_fonts(font_dir))
+
+
+def font_paths(font_dir, script=None):
+    return [info['path'] for info in font_registry(font_dir) if script is None or script in info['scripts']]
+
+
+def font_label(path):
+    info = font_info(path) if os.path.exists(path) else {}
+    if info.get('family'):
+        return f"{info['family']} {info['style']}"
+    return os.path.splitext(os.path.basename(path))[0]
@@ -0,0 +1,56 @@
+from PIL import Image, ImageDraw
+
+from modules import trace
+from modules.cache import LRUCache
+from modules.fonts import load_font
+
+
+# Rasterized text runs keyed by (word, font, size, stroke width). Colour is
+# applied when the masks are pasted, so a colour sweep over the same words
+# only touches FreeType on the first pass.
+
+def run_nbytes(run):
+    return sum(mask.width * mask.height for mask in (run['fill'], run['stroke']) if mask is not None)
+
+
+glyph_cache = LRUCache(maxsize=512, maxbytes=64 << 20, sizeof=run_nbytes)
+
+
+def rasterize_run(word, font_path, size, stroke_width):
+    with trace.span("glyph_rasterize"):
+        font = load_font(font_path, size)
+        measure = ImageDraw.Draw(Image.new("L", (1, 1)))
+        # Layout size, measured as process_logotext always has: default anchor, no stroke
+        bbox = measure.textbbox((0, 0), word, font=font)
+        left, top, right, bottom = measure.textbbox((0, 0), word, font=font, anchor='lt', stroke_width=stroke_width)
+        size_wh = (max(right - left, 1), max(bottom - top, 1))
+
+        fill = Image.new("L", size_wh, 0)
+        ImageDraw.Draw(fill).text((-left, -top), word, fill=255, font=font, anchor='lt')
+        stroke = None
+        if stroke_width:
+            stroke = Image.new("L", size_wh, 0)
+            ImageDraw.Draw(stroke).text((-left, -top), word, fill=255, font=font, anchor='lt', stroke_width=stroke_width)
+    return {
+        'width': bbox[2] - bbox[0],
+        'height': bbox[3] - bbox[1],
+        'offset': (left, top),
+        'stroke_width': stroke_width,
+        'fill': fill,
+        'stroke': stroke,
+    }
+
+
+def text_run_masks(word, font_path, size, stroke_width=0):
+    key = (word, font_path, size, stroke_width)
+    return glyph_cache.get_or_create(key, lambda: rasterize_run(word, font_path, size, stroke_width))
+
+
+def paste_run(image, run, position, fill, stroke_fill=None):
+    # Same layering as ImageDraw.text: the stroke first, then the fill on top.
+    # Without a stroke colour the stroke takes the fill colour, as there.
+    x, y = position[0] + run['offset'][0], position[1] + run['offset'][1]
+    if run['stroke_width']:
+        image.paste(fill if stroke_fill is None else stroke_fill, (x, y), run['stroke'])
+    image.paste(fill, (x, y), run['fill'])
+    return image
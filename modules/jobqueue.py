@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import traceback
+
+from modules import trace
+from modules.manifest import open_manifest, render_incremental
+from modules.checkpoint import open_checkpoint, job_hash, render_resumable
+from modules.animation import open_animation
+from modules.pyramid import open_pyramid
+from modules.store import open_store
+
+
+# Render jobs persisted in SQLite and run by worker threads in the server
+# process, so a Streamlit rerun only polls instead of rendering again.
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+ACTIVE = (QUEUED, RUNNING)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    trace TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority DESC, id);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key);
+"""
+
+
+class JobQueue:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+            if 'trace' not in {row['name'] for row in db.execute("PRAGMA table_info(jobs)")}:
+                # Queues created before jobs recorded their trace
+                db.execute("ALTER TABLE jobs ADD COLUMN trace TEXT")
+
+    def connect(self):
+        # One short-lived connection per call keeps the queue usable from any thread
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        return Connection(db)
+
+    def submit(self, payload, priority=0, key=None, retry=False):
+        key = key or payload_key(payload)
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            # Identical requests share one job, so another session's rerun attaches to it.
+            # Failed and cancelled jobs stay that way until retried explicitly.
+            row = db.execute("SELECT * FROM jobs WHERE key = ? ORDER BY id DESC LIMIT 1", (key,)).fetchone()
+            reusable = row is not None and (
+                row['status'] in ACTIVE
+                or (row['status'] == DONE and outputs_exist(row))
+                or (row['status'] in (FAILED, CANCELLED) and not retry))
+            if reusable:
+                db.execute("COMMIT")
+                return row['id']
+            cursor = db.execute(
+                "INSERT INTO jobs (key, status, priority, payload, total, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, QUEUED, priority, json.dumps(payload, default=str), len(payload['tasks']), time.time()))
+            db.execute("COMMIT")
+            return cursor.lastrowid
+
+    def claim(self):
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY priority DESC, id LIMIT 1", (QUEUED,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET status = ?, started = ? WHERE id = ?", (RUNNING, time.time(), row['id']))
+            db.execute("COMMIT")
+        return None if row is None else job_dict(row, with_payload=True)
+
+    def progress(self, job_id, done):
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET done = ? WHERE id = ?", (done, job_id))
+            row = db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row['cancel_requested'])
+
+    def finish(self, job_id, status, result=None, error=None, spans=None):
+        with self.connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, trace = ?, finished = ? WHERE id = ?",
+                (status, None if result is None else json.dumps(result), error,
+                 None if spans is None else json.dumps(spans), time.time(), job_id))
+
+    def cancel(self, job_id):
+        with self.connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                (CANCELLED, time.time(), job_id, QUEUED))
+            db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?", (job_id, RUNNING))
+
+    def set_priority(self, job_id, priority):
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET priority = ? WHERE id = ? AND status = ?", (priority, job_id, QUEUED))
+
+    def get(self, job_id, with_payload=False):
+        with self.connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else job_dict(row, with_payload)
+
+    def jobs(self, statuses=ACTIVE, limit=50):
+        marks = ", ".join("?" * len(statuses))
+        with self.connect() as db:
+            rows = db.execute(
+                f"SELECT * FROM jobs WHERE status IN ({marks}) ORDER BY priority DESC, id LIMIT ?",
+                (*statuses, limit)).fetchall()
+        return [job_dict(row) for row in rows]
+
+    def requeue_running(self):
+        # Jobs left running by a dead server start again; their checkpoints skip finished variants
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+
+
+class Connection:
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.db.in_transaction:
+            self.db.execute("ROLLBACK")
+        self.db.close()
+
+
+def job_dict(row, with_payload=False):
+    job = {k: row[k] for k in row.keys() if k != 'payload'}
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    job['trace'] = json.loads(job['trace']) if job['trace'] else None
+    if with_payload:
+        job['payload'] = json.loads(row['payload'])
+    return job
+
+
+def payload_key(payload):
+    # Output names carry the submit timestamp, so only what affects pixels identifies a job
+    anim = payload.get('animation')
+    return job_hash(
+        payload['temp_dir'], payload['ext'],
+        [params for _, params, _ in payload['tasks']],
+        anim and {k: v for k, v in anim.items() if k != 'path'},
+        bool(payload.get('pyramid')))
+
+
+def outputs_exist(row):
+    result = json.loads(row['result']) if row['result'] else []
+    return all(os.path.exists(path) for path in result)
+
+
+def run_render(payload, on_progress=None):
+    # payload: temp_dir, ext, timestamp, workers, tasks [[index, params, path]], animation {path, format, delay, palette} | None,
+    # pyramid {path} | None, profile, caches {font_cache_size, layer_cache_size, asset_cache_mb}
+    temp_dir = payload['temp_dir']
+    task_map = {index: (params, path) for index, params, path in payload['tasks']}
+    anim = payload.get('animation')
+    keep_images = anim is not None
+
+    # Variants whose parameters and assets are unchanged since an earlier run are reused from disk
+    manifest = open_manifest(temp_dir)
+    # An interrupted job resumes from its checkpoint instead of starting over
+    checkpoint = open_checkpoint(temp_dir, job_hash(payload['ext'], [params for params, _ in task_map.values()]), payload['timestamp'])
+    animation = open_animation(anim['path'], anim['format'], anim['delay'], palette=anim.get('palette')) if anim else None
+    store = open_store(temp_dir, payload['timestamp'])
+    pyramid = None
+    if payload.get('pyramid'):
+        pyramid = open_pyramid(payload['pyramid']['path'], max(task_map, default=0))
+
+    def render_pending(pending):
+        return render_incremental([task_map[index] for index in pending], manifest, payload['workers'],
+                                  keep_images=keep_images, settings=payload.get('caches'))
+
+    image_paths = []
+    results = render_resumable(list(task_map), checkpoint, render_pending, keep_images=keep_images)
+    try:
+        # Results come in task order; a reused output may carry another run's name
+        for count, (index, result) in enumerate(zip(task_map, results), start=1):
+            image_path = result[0] if animation is not None else result
+            # Frames go straight from the renderer into the animation, once per distinct image
+            if store.add(image_path, index, task_map[index][0]) and animation is not None:
+                animation.append(result[1])
+            image_paths.append(image_path)
+            if pyramid is not None:
+                pyramid.add(index, image_path)
+            if on_progress is not None and on_progress(count):
+                break
+    finally:
+        results.close()
+        checkpoint.close()
+        manifest.save()
+        store.close()
+        if pyramid is not None:
+            pyramid.close()
+        if animation is not None and animation.frame_count:
+            animation.close()
+            image_paths.append(animation.path)
+    return image_paths
+
+
+def run_job(queue, job):
+    if job['payload'].get('profile'):
+        # The trace is process-wide, so one profiled job records at a time;
+        # spans from a job running beside it on another worker land in it too
+        with _trace_lock:
+            trace.reset()
+            trace.enable()
+            try:
+                status, image_paths, error = run_job_render(queue, job)
+            finally:
+                trace.enable(False)
+                spans = trace.drain()
+    else:
+        status, image_paths, error = run_job_render(queue, job)
+        spans = None
+    queue.finish(job['id'], status, result=image_paths, error=error, spans=spans)
+
+
+def run_job_render(queue, job):
+    try:
+        image_paths = run_render(job['payload'], lambda count: queue.progress(job['id'], count))
+    except Exception:
+        return FAILED, None, traceback.format_exc()
+    cancelled = queue.get(job['id'])['cancel_requested']
+    return CANCELLED if cancelled else DONE, image_paths, None
+
+
+def worker_loop(queue, poll_interval=0.5):
+    while True:
+        job = queue.claim()
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        run_job(queue, job)
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+_trace_lock = threading.Lock()
+
+
+def start_workers(path, count=1):
+    # Idempotent per queue file; Streamlit calls this on every script run
+    with _workers_lock:
+        if path in _workers:
+            return _workers[path][0]
+        queue = JobQueue(path)
+        queue.requeue_running()
+        threads = [threading.Thread(target=worker_loop, args=(queue,), name=f"render-job-{i}", daemon=True) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        _workers[path] = (queue, threads)
+        return queue
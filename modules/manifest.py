@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+from PIL import Image
+
+from modules import trace
+from modules.cache import LRUCache
+from modules.common import atomic_path
+from modules.identicon import IDENTICON_VERSION
+from modules.parallel import render_tasks_parallel
+
+
+# Bump when a change to the render code alters pixels, so old outputs are redrawn
+RENDER_VERSION = 2
+
+MANIFEST_FNAME = "manifest.json"
+
+file_digest_cache = LRUCache(maxsize=256)
+
+
+def file_digest(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    def digest():
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    return file_digest_cache.get_or_create((path, stat.st_mtime_ns, stat.st_size), digest)
+
+
+def variant_hash(params, ext):
+    assets = {run['font']: file_digest(run['font']) for run in params.get('text_runs', [])}
+    # An overlay edited in place keeps its path, so its bytes count too
+    assets.update((path, file_digest(path)) for path in params.get('images', []) + params.get('masks', []))
+    payload = {
+        'render_version': RENDER_VERSION,
+        'identicon_version': IDENTICON_VERSION,
+        'ext': ext,
+        'params': params,
+        'assets': assets,
+    }
+    data = json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class RenderManifest:
+    def __init__(self, path):
+        self.path = path
+        self.variants = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.variants = json.load(f).get('variants', {})
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable manifest {path}. Reason: {e}")
+
+    def lookup(self, digest):
+        entry = self.variants.get(digest)
+        if entry and os.path.exists(entry['path']):
+            return entry['path']
+        return None
+
+    def record(self, digest, path):
+        self.variants[digest] = {'path': path}
+
+    def save(self):
+        # Drop entries whose files were removed, e.g. by the Reset button
+        self.variants = {k: v for k, v in self.variants.items() if os.path.exists(v['path'])}
+        with atomic_path(self.path) as temp_path, open(temp_path, mode='w', encoding='utf-8') as f:
+            json.dump({'version': 1, 'variants': self.variants}, f, ensure_ascii=False, indent=2)
+
+
+def open_manifest(temp_dir):
+    return RenderManifest(os.path.join(temp_dir, MANIFEST_FNAME))
+
+
+def render_incremental(tasks, manifest, workers=None, keep_images=False, settings=None):
+    digests = [variant_hash(params, os.path.splitext(path)[1]) for params, path in tasks]
+    reused = [manifest.lookup(digest) for digest in digests]
+    dirty = [task for task, cached_path in zip(tasks, reused) if cached_path is None]
+
+    rendered = render_tasks_parallel(dirty, workers, keep_images=keep_images, settings=settings)
+    for digest, cached_path in zip(digests, reused):
+        if cached_path is None:
+            result = next(rendered)
+            manifest.record(digest, result[0] if keep_images else result)
+            yield result
+        elif keep_images:
+            trace.count("variants_reused")
+            with Image.open(cached_path) as image:
+                yield cached_path, image.convert("RGBA")
+        else:
+            trace.count("variants_reused")
+            yield cached_path
@@ -0,0 +1,155 @@
+import os
+import math
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from modules import trace
+from modules.fonts import font_cache
+from modules.assets import asset_cache
+from modules.render import layer_cache, variant_space, variant_params, output_path, render_to_file, render_to_file_async
+
+
+# Job settings shared by every shard of a worker process, set once by init_worker
+_job = {}
+
+# Kept frames travel back to the parent whole, so their shards are small and
+# only a few per worker are in flight: the parent holds a bounded number of
+# frames however long the batch
+FRAME_SHARD_SIZE = 2
+SHARDS_AHEAD = 2
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def cache_settings(spec):
+    # The per-process cache sizes from settings.json, small enough to hand to every worker
+    return {key: spec[key] for key in ('font_cache_size', 'layer_cache_size', 'asset_cache_mb') if key in spec}
+
+
+def configure_caches(settings):
+    font_cache.resize(settings.get('font_cache_size', font_cache.maxsize))
+    layer_cache.resize(settings.get('layer_cache_size', layer_cache.maxsize))
+    asset_cache.resize(maxbytes=settings.get('asset_cache_mb', asset_cache.maxbytes >> 20) << 20)
+
+
+def configure_job(spec, temp_dir, ext, checked_lists, keep_images=False, traced=False):
+    _job.update(spec=spec, temp_dir=temp_dir, ext=ext, keep_images=keep_images, traced=traced)
+    _job['space'] = variant_space(spec, checked_lists)
+    configure_caches(cache_settings(spec))
+
+
+def init_worker(traced, settings, job_args=None):
+    # Initializer of both pools; only render_images_parallel has a job to set up
+    init_trace(traced)
+    configure_caches(settings)
+    if job_args is not None:
+        configure_job(*job_args)
+
+
+def init_trace(traced):
+    # Forked workers inherit the parent's spans; start from zero so merge() does not double count
+    trace.reset()
+    trace.enable(traced)
+
+
+def shard_indices(indices, shard_size):
+    # Slicing a range gives a range, so contiguous shards pickle as three ints
+    for shard_start in range(0, len(indices), shard_size):
+        yield indices[shard_start:shard_start + shard_size]
+
+
+def pipelined(submit, items, depth=4):
+    # Keeps up to depth encodes in flight behind the render loop, yielding results in order
+    pending = deque()
+    for item in items:
+        pending.append(submit(item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def render_shard(indices):
+    spec = _job['spec']
+
+    def submit(indexed):
+        index, variant = indexed
+        temp_image_path = output_path(_job['temp_dir'], index, spec['timestamp'], _job['ext'])
+        return render_to_file_async(variant_params(spec, variant), temp_image_path, _job['keep_images'])
+
+    paths = list(pipelined(submit, _job['space'].iter(indices)))
+    if _job['traced']:
+        # Spans recorded in a worker travel back with its results
+        return paths, trace.drain()
+    return paths
+
+
+def render_task(task, keep_image=False, traced=False):
+    params, temp_image_path = task
+    if traced:
+        return render_to_file(params, temp_image_path, keep_image), trace.drain()
+    return render_to_file(params, temp_image_path, keep_image)
+
+
+def render_images_parallel(spec, temp_dir, ext, limits_gen=None, checked_lists=None, workers=None, shard_size=32, keep_images=False, indices=None):
+    if indices is None:
+        indices = variant_space(spec, checked_lists).indices()
+    if limits_gen is not None:
+        indices = indices[:limits_gen]
+    total = len(indices)
+    os.makedirs(temp_dir, exist_ok=True)
+
+    workers = workers or default_workers()
+    traced = trace.enabled()
+    # Keep several shards per worker so a slow shard does not stall the tail of the batch
+    shard_size = max(1, min(shard_size, math.ceil(total / (workers * 4))))
+    if keep_images:
+        shard_size = min(shard_size, FRAME_SHARD_SIZE)
+    shards = shard_indices(indices, shard_size)
+
+    if workers == 1:
+        # In-process spans land in this process's trace directly
+        configure_job(spec, temp_dir, ext, checked_lists, keep_images, traced=False)
+        for shard in shards:
+            yield from render_shard(shard)
+        return
+
+    initargs = (traced, cache_settings(spec), (spec, temp_dir, ext, checked_lists, keep_images, traced))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=initargs) as executor:
+        try:
+            # Results stream back in submission order, so paths arrive by index;
+            # unlike map(), only a window of shards is submitted ahead
+            submit = functools.partial(executor.submit, render_shard)
+            for paths in pipelined(submit, shards, workers * SHARDS_AHEAD):
+                if traced:
+                    paths, spans = paths
+                    trace.merge(spans)
+                yield from paths
+        finally:
+            # A consumer that stops early (e.g. a cancelled job) should not wait for the whole batch
+            executor.shutdown(cancel_futures=True)
+
+
+def render_tasks_parallel(tasks, workers=None, keep_images=False, settings=None):
+    # settings: cache sizes as returned by cache_settings()
+    settings = settings or {}
+    workers = workers or default_workers()
+    if workers == 1:
+        configure_caches(settings)
+        yield from pipelined(lambda task: render_to_file_async(task[0], task[1], keep_images), tasks)
+        return
+
+    traced = trace.enabled()
+    task = functools.partial(render_task, keep_image=keep_images, traced=traced)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(traced, settings)) as executor:
+        try:
+            for result in pipelined(functools.partial(executor.submit, task), tasks, workers * SHARDS_AHEAD):
+                if traced:
+                    result, spans = result
+                    trace.merge(spans)
+                yield result
+        finally:
+            executor.shutdown(cancel_futures=True)
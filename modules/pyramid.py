@@ -0,0 +1,203 @@
+import os
+import json
+import math
+import time
+import shutil
+from PIL import Image
+
+from modules import trace
+from modules.common import atomic_path
+from modules.thumbnail import THUMB_EXT
+
+
+# A Deep Zoom (DZI) pyramid over a whole batch. Variant n sits in grid cell
+# n - 1 (row-major), one tile per variant at the deepest level; every level
+# above halves the one below. Tiles are written as variants finish and
+# parent tiles are rebuilt in batches, so a viewer only ever loads the few
+# tiles covering its viewport.
+
+PYRAMID_NAME = "batch"
+
+
+def pyramid_layout(count, columns=None, tile_size=256):
+    columns = columns or max(1, math.ceil(math.sqrt(count)))
+    rows = max(1, math.ceil(count / columns))
+    width, height = columns * tile_size, rows * tile_size
+    return {
+        'count': count,
+        'columns': columns,
+        'rows': rows,
+        'tile_size': tile_size,
+        'width': width,
+        'height': height,
+        'max_level': math.ceil(math.log2(max(width, height))),
+        'format': THUMB_EXT[1:],
+    }
+
+
+def dzi_xml(layout):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{layout["format"]}" '
+        f'Overlap="0" TileSize="{layout["tile_size"]}">\n'
+        f'  <Size Width="{layout["width"]}" Height="{layout["height"]}"/>\n'
+        '</Image>\n')
+
+
+class TilePyramid:
+    def __init__(self, path, layout, flush_every=512, flush_interval=2.0):
+        # Parents are rebuilt every flush_every new tiles or flush_interval
+        # seconds, whichever comes first, so a viewer sees a small batch fill in
+        self.path = path
+        self.layout = layout
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+        self.dirty = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def max_level(self):
+        return self.layout['max_level']
+
+    def level_size(self, level):
+        scale = 2 ** (self.max_level - level)
+        return -(-self.layout['width'] // scale), -(-self.layout['height'] // scale)
+
+    def level_tiles(self, level):
+        tile_size = self.layout['tile_size']
+        width, height = self.level_size(level)
+        return -(-width // tile_size), -(-height // tile_size)
+
+    def tile_path(self, level, col, row):
+        return os.path.join(self.path, f"{PYRAMID_NAME}_files", str(level), f"{col}_{row}.{self.layout['format']}")
+
+    def cell(self, index):
+        return (index - 1) % self.layout['columns'], (index - 1) // self.layout['columns']
+
+    def index_at(self, x, y):
+        # Variant under a pixel of the deepest level, or None between cells
+        tile_size = self.layout['tile_size']
+        col, row = x // tile_size, y // tile_size
+        index = row * self.layout['columns'] + col + 1
+        if 0 <= col < self.layout['columns'] and 1 <= index <= self.layout['count']:
+            return index
+        return None
+
+    def save_tile(self, tile, level, col, row):
+        path = self.tile_path(level, col, row)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_path(path) as temp_path:
+            tile.save(temp_path, format=self.layout['format'].upper())
+
+    def add(self, index, image_path):
+        if not 1 <= index <= self.layout['count']:
+            return
+        col, row = self.cell(index)
+        tile_size = self.layout['tile_size']
+        with trace.span("pyramid_tile"):
+            with Image.open(image_path) as image:
+                image.draft("RGB", (tile_size, tile_size))
+                image = image.convert("RGBA")
+                image.thumbnail((tile_size, tile_size))
+            tile = Image.new("RGBA", (tile_size, tile_size))
+            tile.paste(image, ((tile_size - image.width) // 2, (tile_size - image.height) // 2))
+            self.save_tile(tile, self.max_level, col, row)
+        self.dirty.add((col, row))
+        if len(self.dirty) >= self.flush_every or time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def load_tile(self, level, col, row):
+        path = self.tile_path(level, col, row)
+        if not os.path.exists(path):
+            return None
+        with Image.open(path) as tile:
+            return tile.convert("RGBA")
+
+    def build_parent(self, level, col, row):
+        # Level `level` tile from its (up to) four children one level deeper
+        tile_size = self.layout['tile_size']
+        child_w, child_h = self.level_size(level + 1)
+        region = (min(2 * tile_size, child_w - 2 * col * tile_size), min(2 * tile_size, child_h - 2 * row * tile_size))
+        canvas = Image.new("RGBA", region)
+        for dy in (0, 1):
+            for dx in (0, 1):
+                child = self.load_tile(level + 1, 2 * col + dx, 2 * row + dy)
+                if child is not None:
+                    canvas.paste(child, (dx * tile_size, dy * tile_size))
+        self.save_tile(canvas.reduce(2), level, col, row)
+
+    def flush(self):
+        # Each parent is rebuilt once per flush however many of its children changed
+        dirty = self.dirty
+        with trace.span("pyramid_flush"):
+            for level in range(self.max_level - 1, -1, -1):
+                dirty = {(col // 2, row // 2) for col, row in dirty}
+                for col, row in sorted(dirty):
+                    self.build_parent(level, col, row)
+        self.dirty = set()
+        self.flushed = time.monotonic()
+
+    def stale_tiles(self):
+        # Base tiles newer than their parent, e.g. after an interrupted run
+        base_dir = os.path.dirname(self.tile_path(self.max_level, 0, 0))
+        if not os.path.isdir(base_dir) or self.max_level == 0:
+            return set()
+        stale = set()
+        for name in os.listdir(base_dir):
+            stem, ext = os.path.splitext(name)
+            if ext != "." + self.layout['format']:
+                continue
+            col, row = (int(part) for part in stem.split('_'))
+            parent = self.tile_path(self.max_level - 1, col // 2, row // 2)
+            if not os.path.exists(parent) or os.path.getmtime(parent) < os.path.getmtime(os.path.join(base_dir, name)):
+                stale.add((col, row))
+        return stale
+
+    def viewport(self, level, left, top, width, height):
+        # Composes the visible part of a level from the tiles it overlaps
+        tile_size = self.layout['tile_size']
+        view = Image.new("RGBA", (width, height))
+        cols, rows = self.level_tiles(level)
+        for row in range(max(0, top // tile_size), min(rows, -(-(top + height) // tile_size))):
+            for col in range(max(0, left // tile_size), min(cols, -(-(left + width) // tile_size))):
+                tile = self.load_tile(level, col, row)
+                if tile is not None:
+                    view.paste(tile, (col * tile_size - left, row * tile_size - top))
+        return view
+
+    def close(self):
+        if self.dirty:
+            self.flush()
+
+
+def open_pyramid(path, count, columns=None, tile_size=256, flush_every=512, flush_interval=2.0):
+    # Reopening with the same layout keeps the tiles already built
+    layout = pyramid_layout(count, columns, tile_size)
+    layout_path = os.path.join(path, "pyramid.json")
+    os.makedirs(path, exist_ok=True)
+    previous = None
+    if os.path.exists(layout_path):
+        with open(layout_path, encoding='utf-8') as f:
+            previous = json.load(f)
+    pyramid = TilePyramid(path, layout, flush_every, flush_interval)
+    if previous == layout:
+        pyramid.dirty = pyramid.stale_tiles()
+    else:
+        # Tiles laid out for another batch size would land in the wrong cells
+        shutil.rmtree(os.path.join(path, f"{PYRAMID_NAME}_files"), ignore_errors=True)
+        with open(layout_path, mode='w', encoding='utf-8') as f:
+            json.dump(layout, f)
+        with open(os.path.join(path, f"{PYRAMID_NAME}.dzi"), mode='w', encoding='utf-8') as f:
+            f.write(dzi_xml(layout))
+    return pyramid
+
+
+def load_pyramid(path):
+    with open(os.path.join(path, "pyramid.json"), encoding='utf-8') as f:
+        return TilePyramid(path, json.load(f))
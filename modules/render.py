@@ -0,0 +1,287 @@
+import os
+from PIL import Image
+
+from modules import trace
+from modules.cache import LRUCache
+from modules.common import generate_qr, read_config
+from modules.composite import shape_layers, paste_over
+from modules.assets import get_asset
+from modules.encode import encode_options, save_formats, encode_pool
+from modules.glyphs import text_run_masks, paste_run
+from modules.identicon import get_identicon, circle_mask
+from modules.variants import VariantSpace
+
+
+MULTIPLY_LISTS = ['colorlist', 'wordlist', 'shape', 'qr_text', 'idcon_id']
+
+RENDER_KEYS = [
+    'canvas_w', 'canvas_h', 'bc', 'fc',
+    'radius', 'circle_x', 'circle_y', 'rect_x', 'rect_y', 'margin', 'frame_fill', 'frame_width',
+    'gen_idcon', 'idcon_size', 'idcon_ext', 'idcon_text', 'idcon_position', 'idcon_source', 'identicon_cache_dir',
+    'gen_qr', 'qr_size', 'qr_position', 'qr_border',
+    'image_x', 'image_y', 'image_z', 'mask_x', 'mask_y', 'mask_z',
+]
+
+SHAPE_KEYS = [
+    'canvas_w', 'canvas_h', 'shape', 'bc',
+    'radius', 'circle_x', 'circle_y', 'rect_x', 'rect_y', 'margin', 'frame_fill', 'frame_width',
+]
+IDCON_KEYS = ['idcon_id', 'idcon_size', 'idcon_ext', 'idcon_text', 'idcon_position', 'idcon_source']
+
+# Composited background layers, see background_layer
+layer_cache = LRUCache(maxsize=16)
+
+
+def load_spec(settings_file, ui_config_file=None):
+    spec = {}
+    if ui_config_file:
+        spec.update(read_config(ui_config_file))
+    spec.update(read_config(settings_file))
+    return spec
+
+
+def as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (str, tuple)):
+        return [value]
+    return list(value)
+
+
+def multiply_lists(spec, checked_lists=None):
+    if checked_lists is None:
+        checked_lists = spec.get('multiply', MULTIPLY_LISTS)
+    lists = {}
+    for label in checked_lists:
+        if label == 'wordlist':
+            lists[label] = [tuple(as_list(words)) for words in spec.get('wordlist', [])]
+        elif label == 'colorlist':
+            lists[label] = [tuple(clrs) for clrs in spec.get('colorlist', [])]
+        else:
+            lists[label] = as_list(spec.get(label))
+    return lists
+
+
+def variant_space(spec, checked_lists=None):
+    return VariantSpace(multiply_lists(spec, checked_lists))
+
+
+def variant_count(spec, checked_lists=None):
+    return len(variant_space(spec, checked_lists))
+
+
+def iter_variants(spec, checked_lists=None, indices=None):
+    return variant_space(spec, checked_lists).iter(indices)
+
+
+def text_run(spec, word):
+    stroke_fill = spec.get('stroke_fill', 'black')
+    if isinstance(stroke_fill, list):
+        stroke_fill = stroke_fill[0] if stroke_fill else None
+    font = spec.get('font') or spec['fontlist'][0]
+    return {
+        'word': word,
+        'font': font,
+        'text_x': spec['text_x'],
+        'text_y': spec['text_y'],
+        'text_z': spec['text_z'],
+        'stroke_fill': stroke_fill,
+        'stroke_width': spec['stroke_width'],
+    }
+
+
+def variant_params(spec, variant):
+    params = {k: spec[k] for k in RENDER_KEYS if k in spec}
+    if 'colorlist' in variant:
+        params['bc'], params['fc'] = variant['colorlist']
+    params['shape'] = variant.get('shape')
+    params['idcon_id'] = variant.get('idcon_id')
+    params['qr_text'] = variant.get('qr_text')
+    params['text_runs'] = [text_run(spec, word) for word in variant.get('wordlist', ())]
+    # Overlays are files on disk, so params stay JSON for the job queue and the manifest
+    params['images'] = [path for path in as_list(spec.get('image_dir')) if isinstance(path, str)]
+    params['masks'] = as_list(spec.get('mask')) if spec.get('gen_mask') else []
+    params['encode'] = encode_options(spec)
+    for k in ('idcon_ext', 'idcon_text'):
+        if isinstance(params.get(k), list):
+            params[k] = params[k][0] if params[k] else ""
+    return params
+
+
+def process_shape(image, shape, bc, canvas_w, canvas_h, frame_fill=None, **kwargs):
+    layer = Image.fromarray(shape_layers(shape, [{'bc': bc, 'frame_fill': frame_fill}], canvas_w, canvas_h, **kwargs)[0], "RGBA")
+    if image.getbbox() is None:
+        # Nothing underneath to blend with
+        image.paste(layer)
+    else:
+        image.alpha_composite(layer)
+    return image
+
+
+def process_image(image, image_dir, image_x, image_y, image_z, opacity=1.0):
+    for img_path in image_dir:
+        paste_over(image, get_asset(img_path, image_z), (image_x, image_y), opacity)
+    return image
+
+
+def process_mask(image, mask_dir, mask_x, mask_y, mask_z, opacity=1.0):
+    for img_path in mask_dir:
+        paste_over(image, get_asset(img_path, mask_z), (mask_x, mask_y), opacity)
+    return image
+
+
+def process_logotext(image, word, fonts, fc, text_x, text_y, text_z, stroke_fill, stroke_width, **kwargs):
+    run = text_run_masks(word, fonts, text_z, stroke_width)
+
+    adjusted_text_x = int((kwargs['canvas_w'] - run['width']) * 0.5 + text_x)
+    adjusted_text_y = int((kwargs['canvas_h'] - run['height']) * 0.5 + text_y)
+
+    return paste_run(image, run, (adjusted_text_x, adjusted_text_y), fc, stroke_fill)
+
+
+def process_qr(image, qr_text, qr_size, qr_position, qr_border, **kwargs):
+    qr_size = kwargs['canvas_h'] * 0.005 if kwargs['canvas_h'] < kwargs['canvas_w'] else kwargs['canvas_w'] * 0.005
+    qr_border =  qr_size * 0.2
+    qr_position = (int(kwargs['canvas_w']-30*qr_size),  int(kwargs['canvas_h']-30*qr_size))
+    qr_image = generate_qr(qr_text, qr_size, qr_border)
+    image.paste(qr_image, qr_position)
+    return image
+
+
+def process_idcon(image, id, size, ext, text, position, source="local", cache_dir=None, **kwargs):
+    position = (int((kwargs['canvas_w']-size) * 0.50),  int((kwargs['canvas_h']-size) * 0.50))
+
+    try:
+        identicon = get_identicon(id, size, ext, text, source, cache_dir)
+    except Exception as e:
+        print(f"Failed to fetch identicon {id}. Reason: {e}")
+        return image
+
+    mask = circle_mask(size, cache_dir)
+    image.paste(identicon, position, mask=mask)
+    return image
+
+
+def layer_key(params, keys):
+    return tuple(repr(params.get(k)) for k in keys)
+
+
+def shape_layer(params):
+    image = Image.new("RGBA", (params['canvas_w'], params['canvas_h']), (0, 0, 0, 0))
+
+    if params.get('shape'):
+        with trace.span("process_shape"):
+            image = process_shape(
+                image,
+                params['shape'],
+                params.get('bc'),
+                params['canvas_w'],
+                params['canvas_h'],
+                radius=params['radius'],
+                circle_x=params['circle_x'],
+                circle_y=params['circle_y'],
+                rect_x=params['rect_x'],
+                rect_y=params['rect_y'],
+                margin=params['margin'],
+                frame_fill=params['frame_fill'],
+                frame_width=params['frame_width']
+            )
+    return image
+
+
+def idcon_layer(params):
+    image = background_layer(params, with_idcon=False).copy()
+    with trace.span("process_idcon"):
+        return process_idcon(image,
+            params['idcon_id'],
+            params['idcon_size'],
+            params['idcon_ext'],
+            params['idcon_text'],
+            params['idcon_position'],
+            params.get('idcon_source', 'local'),
+            params.get('identicon_cache_dir'),
+            canvas_w=params['canvas_w'],
+            canvas_h=params['canvas_h']
+        )
+
+
+def background_layer(params, with_idcon=True):
+    # Shape and identicon do not depend on text or QR, so variants that only
+    # differ in those share one composited background. Callers must copy it.
+    key = layer_key(params, SHAPE_KEYS)
+    if not with_idcon or not (params.get('idcon_id') and params.get('gen_idcon')):
+        return layer_cache.get_or_create(('shape',) + key, lambda: shape_layer(params))
+    key += layer_key(params, IDCON_KEYS)
+    return layer_cache.get_or_create(('idcon',) + key, lambda: idcon_layer(params))
+
+
+def render_variant(params):
+    with trace.span("layer_copy"):
+        image = background_layer(params).copy()
+
+    for run in params.get('text_runs', []):
+        with trace.span("process_logotext"):
+            image = process_logotext(
+                image,
+                run['word'],
+                run['font'],
+                params.get('fc'),
+                run['text_x'],
+                run['text_y'],
+                run['text_z'],
+                run['stroke_fill'],
+                run['stroke_width'],
+                canvas_w=params['canvas_w'],
+                canvas_h=params['canvas_h']
+            )
+
+    if params.get('images'):
+        with trace.span("process_image"):
+            image = process_image(image, params['images'], params['image_x'], params['image_y'], params['image_z'])
+
+    if params.get('masks'):
+        with trace.span("process_mask"):
+            image = process_mask(image, params['masks'], params['mask_x'], params['mask_y'], params['mask_z'])
+
+    if params.get('qr_text') and params.get('gen_qr'):
+        with trace.span("process_qr"):
+            image = process_qr(image,
+                params['qr_text'],
+                params['qr_size'],
+                params['qr_position'],
+                params['qr_border'],
+                canvas_w=params['canvas_w'],
+                canvas_h=params['canvas_h']
+            )
+
+    return image
+
+
+def output_path(temp_dir, index, timestamp, ext):
+    return os.path.join(temp_dir, f"{index:05d}-{timestamp}{ext}")
+
+
+def encode_to_file(image, temp_image_path, options, keep_image=False):
+    save_formats(image, temp_image_path, options)
+    trace.count("variants_rendered")
+    if keep_image:
+        return temp_image_path, image
+    return temp_image_path
+
+
+def render_to_file_async(params, temp_image_path, keep_image=False):
+    # Composites here and encodes on the encode pool, so the next render can start
+    with trace.span("render_variant"):
+        image = render_variant(params)
+    return encode_pool().submit(encode_to_file, image, temp_image_path, params.get('encode'), keep_image)
+
+
+def render_to_file(params, temp_image_path, keep_image=False):
+    return render_to_file_async(params, temp_image_path, keep_image).result()
+
+
+def render_images(spec, temp_dir, ext, limits_gen=None, checked_lists=None):
+    os.makedirs(temp_dir, exist_ok=True)
+    space = variant_space(spec, checked_lists)
+    for index, variant in space.iter(space.indices(stop=limits_gen)):
+        yield render_to_file(variant_params(spec, variant), output_path(temp_dir, index, spec['timestamp'], ext))
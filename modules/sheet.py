@@ -0,0 +1,157 @@
+import os
+import math
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+from modules import trace
+
+
+# Contact sheets are assembled one grid row at a time: only the headers of
+# all inputs are read up front, and each row strip is decoded, written out and
+# dropped before the next, so memory follows one row rather than the sheet.
+
+PNG_COLOR_TYPES = {'L': 0, 'RGB': 2, 'RGBA': 6}
+
+
+def fit_size(size, cell):
+    if cell is None:
+        return size
+    scale = min(cell[0] / size[0], cell[1] / size[1], 1.0)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def read_size(path):
+    # Image.open only parses the header
+    with Image.open(path) as image:
+        return image.size
+
+
+def sheet_layout(image_paths, columns, cell=None, gap=0):
+    # Columns are as wide as their widest image and rows as tall as their
+    # tallest, so mixed sizes line up without being scaled to one another
+    sizes = [fit_size(read_size(path), cell) for path in image_paths]
+    rows = math.ceil(len(sizes) / columns) if sizes else 0
+    col_widths = [max((w for w, _ in sizes[c::columns]), default=0) for c in range(columns)]
+    row_heights = [max(h for _, h in sizes[r * columns:(r + 1) * columns]) for r in range(rows)]
+    return {
+        'paths': list(image_paths),
+        'sizes': sizes,
+        'columns': columns,
+        'col_x': [sum(col_widths[:c]) + gap * c for c in range(columns)],
+        'col_widths': col_widths,
+        'row_y': [sum(row_heights[:r]) + gap * r for r in range(rows)],
+        'row_heights': row_heights,
+        'width': sum(col_widths) + gap * max(columns - 1, 0),
+        'height': sum(row_heights) + gap * max(rows - 1, 0),
+        'gap': gap,
+    }
+
+
+def load_cell(path, size, mode):
+    with Image.open(path) as image:
+        # JPEG can decode straight at a reduced scale
+        image.draft(mode, size)
+        image = image.convert("RGBA")
+        if image.size != size:
+            image = image.resize(size, Image.LANCZOS)
+    return image
+
+
+def sheet_strips(layout, mode="RGB", background=None, workers=4):
+    # Yields (y, strip) per grid row; gaps between rows come as their own strips
+    background = background or ((255, 255, 255) if mode == "RGB" else 0)
+    columns = layout['columns']
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for r, (row_y, row_h) in enumerate(zip(layout['row_y'], layout['row_heights'])):
+            if r and layout['gap']:
+                yield row_y - layout['gap'], Image.new(mode, (layout['width'], layout['gap']), background)
+            cells = range(r * columns, min((r + 1) * columns, len(layout['paths'])))
+            with trace.span("sheet_row"):
+                images = executor.map(lambda i: load_cell(layout['paths'][i], layout['sizes'][i], mode), cells)
+                strip = Image.new(mode, (layout['width'], row_h), background)
+                for i, image in zip(cells, images):
+                    c = i % columns
+                    x = layout['col_x'][c] + (layout['col_widths'][c] - image.width) // 2
+                    y = (row_h - image.height) // 2
+                    strip.paste(image, (x, y), image)
+            yield row_y, strip
+
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def write_png_strips(path, width, height, mode, strips, level=6, band_rows=64):
+    # PNG rows are independent once filtered, so the file is written as the
+    # strips arrive. Every row uses the Up filter (type 2).
+    compressor = zlib.compressobj(level)
+    previous = None
+    with open(path, 'wb') as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[mode], 0, 0, 0)))
+        for _, strip in strips:
+            with trace.span("sheet_encode"):
+                pixels = np.asarray(strip).reshape(strip.height, -1)
+                # Filtered in bands so the temporaries stay a fraction of the strip
+                for top in range(0, pixels.shape[0], band_rows):
+                    band = pixels[top:top + band_rows]
+                    rows = np.empty((band.shape[0], band.shape[1] + 1), dtype=np.uint8)
+                    rows[:, 0] = 2
+                    np.subtract(band[:1], 0 if previous is None else previous, out=rows[:1, 1:])
+                    np.subtract(band[1:], band[:-1], out=rows[1:, 1:])
+                    previous = band[-1].copy()
+                    data = compressor.compress(rows.data)
+                    if data:
+                        f.write(png_chunk(b"IDAT", data))
+        f.write(png_chunk(b"IDAT", compressor.flush()))
+        f.write(png_chunk(b"IEND", b""))
+    return path
+
+
+def write_tiles(out_dir, strips, tile_size=1024, mode="RGB", ext=".png"):
+    # Re-bands the row strips into tile_size bands and cuts each into
+    # <row>_<col> tiles. Holds at most one band plus one strip.
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    band, band_y, tile_row = None, 0, 0
+
+    def flush(band, tile_row):
+        for tile_col, x in enumerate(range(0, band.width, tile_size)):
+            tile_path = os.path.join(out_dir, f"{tile_row}_{tile_col}{ext}")
+            band.crop((x, 0, min(x + tile_size, band.width), band.height)).save(tile_path)
+            paths.append(tile_path)
+
+    for y, strip in strips:
+        offset = 0
+        while offset < strip.height:
+            if band is None:
+                band, band_y = Image.new(mode, (strip.width, tile_size)), 0
+            take = min(tile_size - band_y, strip.height - offset)
+            band.paste(strip.crop((0, offset, strip.width, offset + take)), (0, band_y))
+            band_y += take
+            offset += take
+            if band_y == tile_size:
+                flush(band, tile_row)
+                band, tile_row = None, tile_row + 1
+    if band is not None:
+        flush(band.crop((0, 0, band.width, band_y)), tile_row)
+    return paths
+
+
+def write_sheet(image_paths, out_path, columns=None, cell=None, gap=0, mode="RGB", background=None, tile_size=1024):
+    # out_path ending in .png gets one streamed PNG; anything else is taken
+    # as a directory of tile_size PNG tiles
+    if not image_paths:
+        raise ValueError("no images for the contact sheet")
+    columns = columns or max(1, math.ceil(math.sqrt(len(image_paths))))
+    layout = sheet_layout(image_paths, columns, cell, gap)
+    strips = sheet_strips(layout, mode, background)
+    with trace.span("write_sheet"):
+        if out_path.lower().endswith(".png"):
+            write_png_strips(out_path, layout['width'], layout['height'], mode, strips)
+        else:
+            write_tiles(out_path, strips, tile_size, mode)
+    return layout
@@ -0,0 +1,217 @@
+import os
+import re
+import json
+import shutil
+
+from modules import trace
+from modules.common import atomic_path
+from modules.manifest import file_digest, MANIFEST_FNAME
+from modules.catalog import OutputCatalog
+
+
+# Rendered files keep their {index:05d}-{timestamp}{ext} names in the output
+# directory, but each is a hard link to a blob under .store/blobs named by the
+# sha256 of its bytes, so identical renders take the disk space of one. Every
+# run lists its files in .store/runs/<timestamp>.json; the garbage collector
+# keeps whatever the runs it keeps refer to and deletes the rest. The
+# catalog indexes every stored output by its render parameters.
+
+STORE_DIR = ".store"
+RUN_TIMESTAMP = re.compile(r"\d{8}_\d{6}")
+# Names the tool writes into temp_dir: renders and their sibling formats,
+# animations (index 00000), sheets, pyramids and archives, plus leftover .tmp files
+OWNED_NAME = re.compile(r"(?:\d{5}|sheet|pyramid|archive)-(\d{8}_\d{6})(?:\..+)?")
+
+
+def store_root(temp_dir):
+    return os.path.join(temp_dir, STORE_DIR)
+
+
+def blob_path(temp_dir, digest, ext):
+    return os.path.join(store_root(temp_dir), "blobs", digest[:2], f"{digest}{ext.lower()}")
+
+
+def run_path(temp_dir, timestamp):
+    return os.path.join(store_root(temp_dir), "runs", f"{timestamp}.json")
+
+
+def catalog_path(temp_dir):
+    return os.path.join(store_root(temp_dir), "catalog.sqlite3")
+
+
+def open_catalog(temp_dir):
+    return OutputCatalog(catalog_path(temp_dir))
+
+
+def link_blob(path, blob):
+    # Returns True when path was a duplicate and now shares the blob's storage
+    if not os.path.exists(blob):
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+        except OSError:
+            # No hard links here (e.g. another device): the blob is a copy
+            shutil.copyfile(path, blob)
+        return False
+    if os.path.samefile(path, blob):
+        return False
+    try:
+        with atomic_path(path) as temp_path:
+            os.link(blob, temp_path)
+    except OSError:
+        return False
+    return True
+
+
+class OutputStore:
+    def __init__(self, temp_dir, timestamp, save_every=256):
+        self.temp_dir = temp_dir
+        self.timestamp = timestamp
+        self.save_every = save_every
+        self.path = run_path(temp_dir, timestamp)
+        self.entries = {}
+        self.seen = set()
+        self.unsaved = 0
+        self.catalog = open_catalog(temp_dir)
+        if os.path.exists(self.path):
+            # A resumed run keeps the entries recorded before it was interrupted
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self.entries = {entry['path']: entry for entry in json.load(f)['entries']}
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring unreadable run manifest {self.path}. Reason: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, path, index=None, params=None):
+        # Returns False when the same bytes were already added in this run,
+        # so archives and animations can skip the repeat
+        with trace.span("store_add"):
+            digest = file_digest(path)
+            if link_blob(path, blob_path(self.temp_dir, digest, os.path.splitext(path)[1])):
+                trace.count("outputs_deduplicated")
+        self.entries[path] = {'index': index, 'path': path, 'blob': digest}
+        self.catalog.add(path, params, index, digest)
+        self.unsaved += 1
+        if self.unsaved >= self.save_every:
+            self.save()
+        first = digest not in self.seen
+        self.seen.add(digest)
+        return first
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with atomic_path(self.path) as temp_path, open(temp_path, mode='w', encoding='utf-8') as f:
+            json.dump({'version': 1, 'timestamp': self.timestamp, 'entries': list(self.entries.values())}, f, ensure_ascii=False)
+        self.unsaved = 0
+
+    def close(self):
+        if self.unsaved:
+            self.save()
+        self.catalog.close()
+
+
+def open_store(temp_dir, timestamp):
+    return OutputStore(temp_dir, timestamp)
+
+
+def unique_paths(paths):
+    # First path per distinct content, in order
+    seen = set()
+    for path in paths:
+        digest = file_digest(path)
+        if digest is None or digest not in seen:
+            seen.add(digest)
+            yield path
+
+
+def list_runs(temp_dir):
+    runs_dir = os.path.join(store_root(temp_dir), "runs")
+    if not os.path.isdir(runs_dir):
+        return []
+    return sorted(name[:-5] for name in os.listdir(runs_dir) if name.endswith(".json"))
+
+
+def checkpoint_timestamp(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.loads(f.readline()).get('timestamp')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def remove(path, freed):
+    # Only the last link to a file frees its bytes
+    is_dir = os.path.isdir(path)
+    try:
+        stat = os.lstat(path)
+        if is_dir:
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except OSError as e:
+        print(f"Failed to delete {path}. Reason: {e}")
+        return
+    freed['files'] += 1
+    if not is_dir and stat.st_nlink == 1:
+        freed['bytes'] += stat.st_size
+
+
+def collect_garbage(temp_dir, keep_runs=0):
+    # Keeps the newest keep_runs runs: the files they list and anything named
+    # with their timestamp (animation, sheet, pyramid, checkpoint). Other
+    # outputs, checkpoints and the manifest are removed, then every blob no
+    # kept run refers to. Files the tool did not write are left alone.
+    freed = {'files': 0, 'bytes': 0}
+    runs = list_runs(temp_dir)
+    kept = set(runs[len(runs) - keep_runs:]) if keep_runs else set()
+    keep_paths, keep_blobs = set(), set()
+    for timestamp in kept:
+        try:
+            with open(run_path(temp_dir, timestamp), encoding='utf-8') as f:
+                entries = json.load(f)['entries']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable run manifest {timestamp}. Reason: {e}")
+            continue
+        keep_paths.update(os.path.abspath(entry['path']) for entry in entries)
+        keep_blobs.update(entry['blob'] for entry in entries)
+
+    with trace.span("collect_garbage"):
+        for timestamp in runs:
+            if timestamp not in kept:
+                remove(run_path(temp_dir, timestamp), freed)
+        names = os.listdir(temp_dir) if os.path.isdir(temp_dir) else []
+        for name in names:
+            path = os.path.join(temp_dir, name)
+            if name == STORE_DIR or os.path.abspath(path) in keep_paths:
+                continue
+            if kept and name == MANIFEST_FNAME:
+                # Its entries for removed files are dropped on the next save
+                continue
+            if name == MANIFEST_FNAME:
+                timestamp = None
+            elif name.startswith("job-") and name.endswith(".jsonl"):
+                timestamp = checkpoint_timestamp(path)
+            else:
+                owned = OWNED_NAME.fullmatch(name)
+                if owned is None:
+                    continue
+                timestamp = owned.group(1)
+            if timestamp in kept:
+                continue
+            remove(path, freed)
+        blobs_dir = os.path.join(store_root(temp_dir), "blobs")
+        if os.path.isdir(blobs_dir):
+            for shard in os.listdir(blobs_dir):
+                for name in os.listdir(os.path.join(blobs_dir, shard)):
+                    if os.path.splitext(name)[0] not in keep_blobs:
+                        remove(os.path.join(blobs_dir, shard, name), freed)
+                if not os.listdir(os.path.join(blobs_dir, shard)):
+                    os.rmdir(os.path.join(blobs_dir, shard))
+        if os.path.exists(catalog_path(temp_dir)):
+            open_catalog(temp_dir).prune()
+    return freed
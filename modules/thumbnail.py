@@ -0,0 +1,45 @@
+import os
+from PIL import Image, features
+
+from modules import trace
+from modules.common import atomic_path
+from modules.manifest import file_digest
+
+
+THUMB_EXT = ".webp" if features.check('webp') else ".png"
+
+
+def thumbnail_path(cache_dir, digest, max_size):
+    return os.path.join(cache_dir, digest[:2], f"{digest}_{max_size}{THUMB_EXT}")
+
+
+def get_thumbnail(src_path, max_size=256, cache_dir=".cache/thumbnails"):
+    digest = file_digest(src_path)
+    if digest is None:
+        return src_path
+    path = thumbnail_path(cache_dir, digest, max_size)
+    if os.path.exists(path):
+        return path
+
+    with trace.span("thumbnail"):
+        with Image.open(src_path) as image:
+            # Animations are shown as-is rather than flattened to their first frame
+            if getattr(image, 'is_animated', False) or max(image.size) <= max_size:
+                return src_path
+            image = image.convert("RGBA")
+            image.thumbnail((max_size, max_size))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_path(path) as temp_path:
+            image.save(temp_path, format=THUMB_EXT[1:].upper())
+    return path
+
+
+def page_count(item_count, page_size):
+    return max(1, -(-item_count // page_size))
+
+
+def page_slice(items, page, page_size):
+    page = min(max(1, page), page_count(len(items), page_size))
+    start = (page - 1) * page_size
+    return items[start:start + page_size]
@@ -0,0 +1,162 @@
+import time
+import json
+
+
+# Process-wide tracing. While disabled, span() hands out a shared no-op object
+# and count()/observe() return after one flag check.
+
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+_state = {'enabled': False}
+_histograms = {}
+_counters = {}
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def merge(self, data):
+        self.count += data['count']
+        self.sum += data['sum']
+        if data['min'] is not None:
+            self.min = data['min'] if self.min is None else min(self.min, data['min'])
+            self.max = data['max'] if self.max is None else max(self.max, data['max'])
+        self.buckets = [a + b for a, b in zip(self.buckets, data['buckets'])]
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max, 'buckets': list(self.buckets)}
+
+
+class Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def enable(flag=True):
+    _state['enabled'] = flag
+
+
+def enabled():
+    return _state['enabled']
+
+
+def span(name):
+    if not _state['enabled']:
+        return NULL_SPAN
+    return Span(name)
+
+
+def observe(name, seconds):
+    if not _state['enabled']:
+        return
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms[name] = Histogram()
+    histogram.observe(seconds)
+
+
+def count(name, value=1):
+    if not _state['enabled']:
+        return
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def reset():
+    _histograms.clear()
+    _counters.clear()
+
+
+def snapshot():
+    return {
+        'spans': {name: h.to_dict() for name, h in _histograms.items()},
+        'counters': dict(_counters),
+    }
+
+
+def drain():
+    data = snapshot()
+    reset()
+    return data
+
+
+def merge(data):
+    # Fold in a snapshot taken in another process, e.g. a render worker
+    for name, h in data['spans'].items():
+        _histograms.setdefault(name, Histogram()).merge(h)
+    for name, value in data['counters'].items():
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def summary_rows(data=None):
+    # Rows for this process's trace, or for a snapshot taken elsewhere (e.g. a job's)
+    spans = snapshot()['spans'] if data is None else data['spans']
+    rows = []
+    for name, h in sorted(spans.items()):
+        rows.append({
+            'stage': name,
+            'calls': h['count'],
+            'total_ms': round(h['sum'] * 1000, 2),
+            'mean_ms': round(h['sum'] / h['count'] * 1000, 3) if h['count'] else 0.0,
+            'max_ms': round((h['max'] or 0.0) * 1000, 3),
+        })
+    return rows
+
+
+def to_json():
+    return json.dumps(snapshot(), indent=2)
+
+
+def to_prometheus(prefix="logomaker"):
+    lines = []
+    if _histograms:
+        lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+    for name, h in sorted(_histograms.items()):
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS + ['+Inf'], h.buckets):
+            cumulative += bucket
+            lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {h.sum}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {h.count}')
+    if _counters:
+        lines.append(f"# TYPE {prefix}_events_total counter")
+    for name, value in sorted(_counters.items()):
+        lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
@@ -1,8 +1,8 @@
 import os
 import re
+import datetime
 # import markdown
 # import cairosvg
-import pyshorteners
 from PIL import Image, ImageDraw, ImageFont
 import hashlib
 
@@ -30,26 +30,16 @@ def svg_to_png(svg_data, output_path):
 
 
 def combine_images(image_paths, x, y):
-    images = [Image.open(file) for file in image_paths]
+    from modules.sheet import sheet_layout, sheet_strips
 
-    if len(images) != x * y:
+    if len(image_paths) != x * y:
         return
 
-    widths, heights = zip(*(i.size for i in images))
-
-    total_width = sum(widths[:x])
-    max_height = max(heights[i] for i in range(0, len(images), x))
-
-    combined_image = Image.new('RGB', (total_width, max_height * y))
-
-    x_offset, y_offset = 0, 0
-    for i, image in enumerate(images):
-        combined_image.paste(image, (x_offset, y_offset))
-        x_offset += widths[i]
-
-        if (i + 1) % x == 0:
-            x_offset = 0
-            y_offset += max_height
+    # In-memory sheet for small grids; write_sheet streams large ones to disk
+    layout = sheet_layout(image_paths, x)
+    combined_image = Image.new('RGB', (layout['width'], layout['height']))
+    for y_offset, strip in sheet_strips(layout):
+        combined_image.paste(strip, (0, y_offset))
 
     return combined_image
 
@@ -94,10 +84,18 @@ def full_text_search(query, path_list):
     return matched_files
 
 def filter_by_date_range(from_time, to_time, image_paths):
+    # Bounds may be datetimes, dates or times of day, compared against the
+    # {index}-{YYYYmmdd_HHMMSS} timestamp in each name
     filtered_files = []
     for image_path in image_paths:
-        file_time_str = os.path.basename(image_path).split('-')[1].split('_')[0]
-        file_time = datetime.datetime.strptime(file_time_str, "%Y%m%d").time()
+        match = re.search(r"\d{8}_\d{6}", os.path.basename(image_path))
+        if match is None:
+            continue
+        file_time = datetime.datetime.strptime(match.group(), "%Y%m%d_%H%M%S")
+        if isinstance(from_time, datetime.time):
+            file_time = file_time.time()
+        elif not isinstance(from_time, datetime.datetime):
+            file_time = file_time.date()
         if from_time <= file_time <= to_time:
             filtered_files.append(image_path)
     return filtered_files
@@ -156,6 +154,7 @@ def is_binary(file_path):
 
 
 def shorten_url(url):
+    import pyshorteners
     s = pyshorteners.Shortener(api_key="YOUR_KEY")
     short_url = s.bitly.short(url)
     return short_url
@@ -0,0 +1,52 @@
+import random
+
+
+# Flat 1-based index <-> parameter assignment over the multiplied lists, in the
+# same order as itertools.product (the last list varies fastest).
+
+class VariantSpace:
+    def __init__(self, lists):
+        self.labels = list(lists.keys())
+        self.values = [list(values) for values in lists.values()]
+        self.count = 1
+        for values in self.values:
+            self.count *= len(values)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.iter()
+
+    def variant(self, index):
+        if not 1 <= index <= self.count:
+            raise IndexError(f"variant index {index} out of range 1..{self.count}")
+        remainder = index - 1
+        picked = [None] * len(self.values)
+        for pos in range(len(self.values) - 1, -1, -1):
+            remainder, digit = divmod(remainder, len(self.values[pos]))
+            picked[pos] = self.values[pos][digit]
+        return dict(zip(self.labels, picked))
+
+    def index_of(self, variant):
+        index = 0
+        for label, values in zip(self.labels, self.values):
+            index = index * len(values) + values.index(variant[label])
+        return index + 1
+
+    def indices(self, start=1, stop=None, step=1):
+        stop = self.count if stop is None else min(stop, self.count)
+        return range(max(1, start), stop + 1, step)
+
+    def iter(self, indices=None):
+        for index in self.indices() if indices is None else indices:
+            yield index, self.variant(index)
+
+    def shard(self, shard_id, shard_count, start=1, stop=None):
+        # Strided split: shard k of n takes every n-th index, so shards stay balanced
+        return self.indices(start, stop)[shard_id::shard_count]
+
+    def sample(self, k, seed=None, indices=None):
+        # range supports random.sample without materializing the index space
+        population = self.indices() if indices is None else indices
+        return sorted(random.Random(seed).sample(population, min(k, len(population))))
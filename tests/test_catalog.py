@@ -0,0 +1,28 @@
+from modules.catalog import OutputCatalog
+
+
+def params(bc, word):
+    return {'bc': bc, 'fc': "black", 'shape': "circle", 'text_runs': [{'word': word, 'font': "fonts/a.ttf"}]}
+
+
+def test_flush_same_path_twice(tmp_path):
+    # Two variants with identical params reuse one file, so its path is added twice
+    catalog = OutputCatalog(str(tmp_path / "catalog.sqlite3"))
+    path = str(tmp_path / "00001-20260101_000000.png")
+    catalog.add(path, params("tan", "Logo"), index=1)
+    catalog.add(str(tmp_path / "00002-20260101_000000.png"), params("red", "Logo"), index=2)
+    catalog.add(path, params("tan", "Logo"), index=3)
+    catalog.flush()
+
+    assert catalog.count() == 2
+    assert catalog.query(word="Logo", color="tan") == [path]
+
+    # A later run adding the same path again replaces the row, also in the text index
+    catalog.add(path, params("tan", "Hello"), index=1)
+    catalog.add(path, params("tan", "World"), index=1)
+    catalog.flush()
+
+    assert catalog.count() == 2
+    assert catalog.query(word="World") == [path]
+    assert catalog.query(word="Hello") == []
+    assert len(catalog.query(word="Logo")) == 1
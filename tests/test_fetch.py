@@ -0,0 +1,80 @@
+import os
+import threading
+import http.server
+
+import pytest
+
+from modules import fetch
+
+
+# A local stand-in for image hosts: a little latency on every request, one
+# URL that fails once before answering, one that is missing, and several
+# URLs serving the same bytes.
+
+LATENCY = 0.05
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    requests = []
+    failed = set()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            self.requests.append(self.path)
+        threading.Event().wait(LATENCY)
+        if self.path == "/missing.png":
+            self.send_error(404)
+            return
+        if self.path == "/flaky.png" and self.path not in self.failed:
+            with self.lock:
+                self.failed.add(self.path)
+            self.send_error(503)
+            return
+        body = b"same" if self.path.startswith("/same") else self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    StandIn.requests.clear()
+    StandIn.failed.clear()
+    fetch.fetched_content.clear()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch_all(server, tmp_path):
+    urls = [f"{server}/{i}.png" for i in range(20)]
+    urls += [f"{server}/0.png", f"{server}/same-a.png", f"{server}/same-b.png", f"{server}/flaky.png", f"{server}/missing.png"]
+    results = fetch.fetch_all(urls, str(tmp_path), "png", timeout=5)
+
+    assert [url for url, _ in results] == urls
+    paths = dict(results)
+    assert paths[f"{server}/missing.png"] is None
+    assert open(paths[f"{server}/flaky.png"], 'rb').read() == b"/flaky.png"
+    assert open(paths[f"{server}/3.png"], 'rb').read() == b"/3.png"
+    # Repeated URLs are requested once, identical bytes share one file
+    assert StandIn.requests.count("/0.png") == 1
+    assert paths[f"{server}/same-a.png"] == paths[f"{server}/same-b.png"]
+    assert len(os.listdir(tmp_path)) == 22
+
+
+def test_fetch_all_across_calls(server, tmp_path):
+    fetch.fetch_all([f"{server}/1.png", f"{server}/same-a.png"], str(tmp_path), "png", timeout=5)
+    results = fetch.fetch_all([f"{server}/1.png", f"{server}/same-c.png"], str(tmp_path), "png", timeout=5)
+
+    # A URL on disk is not requested again; new bytes matching an earlier call reuse its file
+    assert StandIn.requests.count("/1.png") == 1
+    assert dict(results)[f"{server}/same-c.png"] == fetch.Fetcher(str(tmp_path), "png").path_for(f"{server}/same-a.png")
+    assert len(os.listdir(tmp_path)) == 2